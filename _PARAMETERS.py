@@ -42,3 +42,37 @@ def generate_parameters(mode, N, J):
         mu = 0
 
         return A, B, Q, R, sigma, lam, mu
+
+
+# Fleets of n independent chargers, given by the diagonals of A, B, Q and R
+
+def generate_fleet_parameters(mode, N, J, n):
+
+    if mode == 'EV' or mode == 'Extreme':
+
+        a = np.ones(n)
+        b = -np.ones(n)
+        q = np.ones(n)
+        r = 0.1*np.ones(n)
+
+        sigma = np.linspace(0,10,N)
+        lam = np.linspace(0,1,J)
+        mu = 0
+
+        return a, b, q, r, sigma, lam, mu
+
+    raise ValueError('Mode ' + str(mode) + ' is not a fleet of independent systems')
+
+
+# Families of a system: Q and R scaled by every pair of q_scales and r_scales, stacked
+# along a leading axis, for matrices and diagonals alike
+
+def scale_family(A, B, Q, R, q_scales, r_scales):
+
+    q, r = (np.ravel(scales).astype(float) for scales in np.meshgrid(q_scales, r_scales, indexing='ij'))
+    shape = (len(q),) + (1,) * np.ndim(Q)
+
+    def stack(M):
+        return np.array(np.broadcast_to(np.asarray(M, dtype=float), (len(q),) + np.shape(M)))
+
+    return stack(A), stack(B), np.reshape(q, shape) * stack(Q), np.reshape(r, shape) * stack(R), q, r
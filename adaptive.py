@@ -0,0 +1,76 @@
+from sweep import run_cells, run_ratios, reduce_sweep
+from instrument import logger
+import numpy as np
+
+
+# Adaptive refinement of the sigma grid
+#
+# Competitive-ratio curves are flat over most of the sigma range and bend in narrow
+# bands. The sweep starts from a coarse grid and bisects, round by round, the
+# intervals of sigma across which a curve changes the most or whose end points have
+# the largest Monte Carlo spread, until every interval is within tol or the budget
+# of sigma points is spent.
+
+def interval_scores(sigma, results, M):
+
+    # Order of the sigma points and the score of every interval between neighbours:
+    # the largest change of a competitive-ratio curve across it, or the largest standard
+    # error of the mean ratio at its ends, relative to the height of the curve there.
+    # Curves spanning orders of magnitude are thus resolved evenly on a log scale
+
+    order = np.argsort(sigma)
+    ratios = np.array([[run_ratios(results[i, j]) for j in range(M)] for i in order])
+    curves = np.max(ratios, axis=1)
+    height = np.maximum(np.maximum(np.abs(curves[:-1]), np.abs(curves[1:])), np.finfo(float).tiny)
+
+    change = np.max(np.abs(np.diff(curves, axis=0)) / height, axis=-1)
+    error = np.std(ratios, axis=1) / np.sqrt(M)
+    spread = np.max(np.maximum(error[:-1], error[1:]) / height, axis=-1)
+
+    return order, np.maximum(change, spread)
+
+
+def adaptive_sweep(model, sigma, M, budget, tol, seed, workers=1, progress_interval=5.0):
+
+    # model as for run_sweep; sigma is the initial grid and budget the largest number of
+    # sigma points. Intervals narrower than a quarter of the spacing of a uniform grid of
+    # `budget` points are not split. Returns the sorted sigma points and the outputs of
+    # reduce_sweep over them
+
+    sigma = list(sigma)
+    J = len(model['lam'])
+    min_width = (max(sigma) - min(sigma)) / (4 * max(budget - 1, 1))
+    results = {}
+    new = list(range(len(sigma)))
+
+    while new:
+
+        model = dict(model, sigma=np.array(sigma))
+        tasks = [(i, j, seed) for i in new for j in range(M)]
+        results.update(run_cells(model, tasks, workers, progress_interval=progress_interval))
+
+        order, scores = interval_scores(sigma, results, M)
+        points = np.array(sigma)[order]
+        logger.info('Adaptive grid: %d sigma points, largest interval score %.3g', len(sigma), np.max(scores))
+
+        # Bisect the intervals scoring above tol and at least half the largest score, highest
+        # first and within the budget, so the refinement goes deep where the curves bend
+        # instead of spreading over every interval above tol
+
+        scores = np.where(np.diff(points) < 2 * min_width, 0, scores)
+        threshold = max(tol, np.max(scores) / 2)
+
+        new = []
+        for k in np.argsort(-scores, kind='stable'):
+            if scores[k] <= tol or scores[k] < threshold or len(sigma) >= budget:
+                break
+            new.append(len(sigma))
+            sigma.append((points[k] + points[k + 1]) / 2)
+
+    # Reduce in increasing order of sigma
+
+    order = np.argsort(sigma)
+    rank = np.argsort(order)
+    results = {(rank[i], j): (rank[i], j) + result[2:] for (i, j), result in results.items()}
+
+    return (np.sort(sigma),) + reduce_sweep(results, len(sigma), M, J)
@@ -0,0 +1,210 @@
+from model import *
+from model import _find_all_lam, _generate_w, _solve_riccati
+from _PARAMETERS import *
+from instrument import logger
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+
+# Benchmark systems: the 4-dim Tracking and 10-dim EV systems of _PARAMETERS.py
+# and scaled-up synthetic ones, driven by EV-style perturbations
+
+def synthetic_system(n, seed=0):
+
+    rng = np.random.default_rng(seed)
+    A = np.eye(n) + 0.05 * rng.standard_normal((n, n))
+    B = rng.standard_normal((n, max(n // 2, 1)))
+    Q = np.eye(n)
+    R = 0.1 * np.eye(max(n // 2, 1))
+
+    return A, B, Q, R
+
+
+def get_system(name):
+
+    if name.startswith('Synthetic'):
+        A, B, Q, R = synthetic_system(int(name[len('Synthetic'):]))
+        return 'EV', A, B, Q, R
+
+    A, B, Q, R, _, _, _ = generate_parameters(name, 1, 1)
+
+    return name, A, B, Q, R
+
+
+# Measurements
+
+def measure(function, repeats, min_time=1.0):
+
+    # Median wall time over at least `repeats` calls, with more calls for fast functions
+    # until min_time seconds are spent, and peak traced memory of one extra call
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        times = []
+        while len(times) < repeats or (sum(times) < min_time and len(times) < 1000):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+    seconds = float(np.median(times))
+
+    return dict(seconds=seconds, peak_mb=peak / 2 ** 20, runs_per_second=1 / seconds)
+
+
+def _pipeline_sweep(mode, T, J):
+
+    # pipeline.main with its INFO progress logging silenced for the timed calls
+
+    import pipeline
+
+    argv = sys.argv
+    level = logger.level
+    sys.argv = ['pipeline.py', '--mode', mode, '--T', str(T), '--N', '3', '--M', '2', '--J', str(J),
+                '--plot_output', '', '--plot_curve', '']
+    logger.setLevel(logging.WARNING)
+    try:
+        pipeline.main()
+    finally:
+        sys.argv = argv
+        logger.setLevel(level)
+
+
+def run_benchmarks(horizons, systems, lams, repeats):
+
+    results = {}
+
+    for system in systems:
+
+        mode, A, B, Q, R = get_system(system)
+        gains = get_gains(A, B, Q, R)
+        P, D, H = gains.P, gains.D, gains.H
+
+        for T in horizons:
+
+            F = FPowers(gains.F, T + 1)
+            noise = generate_noise(0, 0.1, T, A, 'Binomial', np.random.default_rng(0))
+            w = generate_w(mode, A, T)
+            estimated_w = w + noise
+
+            cases = {
+                # The generator itself, not a cache hit
+                'generate_w': lambda: _generate_w(mode, A, T),
+                'generate_noise': lambda: generate_noise(0, 0.1, T, A, 'Binomial', np.random.default_rng(0)),
+                '_find_all_lam': lambda: _find_all_lam(T, w, estimated_w, P, F, H, np.shape(A)[0], 0.3),
+                'run_lqr_robot': lambda: run_lqr_robot(T, A, B, Q, R, noise, 0.5, mode, P, D, H, F),
+                'run_fix_lqr_robot': lambda: run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, 0.3, False),
+            }
+
+            for name, function in cases.items():
+                key = name + '/' + system + '/T=' + str(T)
+                results[key] = measure(function, repeats)
+                print(key + ': ' + str(round(results[key]['seconds'] * 1e3, 3)) + ' ms, '
+                      + str(round(results[key]['peak_mb'], 2)) + ' MB')
+
+    for system in systems:
+
+        # Riccati solutions of 200 scalings of R, batched and one by one
+        mode, A, B, Q, R = get_system(system)
+        family = scale_family(A, B, Q, R, [1], np.logspace(-2, 2, 200))[:4]
+
+        cases = {
+            'solve_riccati_family': lambda: solve_riccati_family(*family),
+            '_solve_riccati': lambda: [_solve_riccati(*member) for member in zip(*family)],
+        }
+
+        for name, function in cases.items():
+            key = name + '/' + system + '/K=200'
+            results[key] = measure(function, repeats)
+            print(key + ': ' + str(round(results[key]['seconds'] * 1e3, 3)) + ' ms, '
+                  + str(round(results[key]['peak_mb'], 2)) + ' MB')
+
+    for system in systems:
+        if system.startswith('Synthetic'):
+            continue
+        for J in lams:
+            key = 'pipeline.main/' + system + '/T=240/J=' + str(J)
+            results[key] = measure(lambda: _pipeline_sweep(system, 240, J), 1)
+            print(key + ': ' + str(round(results[key]['seconds'] * 1e3, 3)) + ' ms, '
+                  + str(round(results[key]['peak_mb'], 2)) + ' MB')
+
+    return results
+
+
+def compare(results, baseline, threshold):
+
+    # Names of the benchmarks that got slower than (1 + threshold) times their baseline
+    # or that have no baseline entry to compare against
+
+    regressions = []
+
+    for key, value in results.items():
+        if key not in baseline:
+            regressions.append(key)
+            print('NO BASELINE ' + key + '; run with --save to record one')
+            continue
+        ratio = value['seconds'] / baseline[key]['seconds']
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            print('REGRESSION ' + key + ': ' + str(round(ratio, 2)) + 'x baseline')
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the model.py hot paths')
+
+    parser.add_argument('--T', default=[240, 1000, 10000], type=int, nargs='+',
+                        help='Horizons to benchmark')
+    parser.add_argument('--systems', default=['Tracking', 'EV', 'Synthetic50'], type=str, nargs='+',
+                        help='Tracking, EV, Extreme or SyntheticN for an N-dim random system')
+    parser.add_argument('--J', default=[6, 50], type=int, nargs='+',
+                        help='Numbers of trust parameters for the end-to-end pipeline sweep')
+    parser.add_argument('--repeats', default=7, type=int,
+                        help='Timed repetitions per benchmark; their median is kept')
+    parser.add_argument('--baseline', default='bench_baseline.json', type=str,
+                        help='JSON baseline to compare against or to write')
+    parser.add_argument('--save', action='store_true',
+                        help='Write the results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', default=0.5, type=float,
+                        help='Allowed slowdown relative to the baseline, 0.5 = 50%%')
+
+    configs = parser.parse_args()
+
+    results = run_benchmarks(configs.T, configs.systems, configs.J, configs.repeats)
+
+    if configs.save:
+        with open(configs.baseline, 'w') as f:
+            json.dump(dict(meta=dict(python=platform.python_version(), numpy=np.__version__,
+                                     machine=platform.machine(), processor=platform.processor()),
+                           results=results), f, indent=2, sort_keys=True)
+        print('Baseline written to ' + configs.baseline)
+        return
+
+    try:
+        with open(configs.baseline) as f:
+            baseline = json.load(f)['results']
+    except FileNotFoundError:
+        print('No baseline at ' + configs.baseline + '; run with --save to record one')
+        return
+
+    if compare(results, baseline, configs.threshold):
+        sys.exit(1)
+
+    print('No regressions beyond ' + str(configs.threshold * 100) + '%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+from model import FPowers
+from instrument import logger
+import numpy as np
+import collections
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import weakref
+from multiprocessing import shared_memory
+
+
+# Read-only model bundles in shared memory
+#
+# The parent copies every array of a sweep model (the system and its gains, the
+# powers of F with their norms, the perturbation trajectory) once into a single
+# shared-memory block. Workers attach to it by name and get read-only NumPy views,
+# so only the small BundleSpec is pickled to them. The block is unlinked when the
+# bundle is closed or garbage collected. Each block is also registered under
+# REGISTRY with the id of its creating process: a parent killed outright never closes
+# its bundle, and its orphaned pool workers keep the resource tracker from cleaning
+# up, so the next bundle created unlinks the blocks of every process that is gone.
+
+BundleSpec = collections.namedtuple('BundleSpec', ['name', 'arrays', 'powers', 'values'])
+
+_ALIGNMENT = 64
+
+REGISTRY = os.path.join(tempfile.gettempdir(), 'lqc-bundles')
+
+
+def _release(memory, entry):
+
+    memory.close()
+    try:
+        memory.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.remove(entry)
+    except FileNotFoundError:
+        pass
+
+
+def _alive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def reclaim_stale_bundles(registry=REGISTRY):
+
+    # Unlinks the blocks of registered bundles whose creating process is gone; returns
+    # their names. Workers still attached to such a block keep their mapping
+
+    reclaimed = []
+
+    for name in os.listdir(registry) if os.path.isdir(registry) else []:
+
+        entry = os.path.join(registry, name)
+        try:
+            with open(entry) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            continue
+        if _alive(pid):
+            continue
+
+        try:
+            memory = shared_memory.SharedMemory(name=name)
+            memory.close()
+            memory.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+        reclaimed.append(name)
+
+    if reclaimed:
+        logger.warning('Reclaimed %d shared-memory blocks of processes that did not exit cleanly', len(reclaimed))
+
+    return reclaimed
+
+
+class ModelBundle:
+
+    # model is a dict as for sweep.run_sweep; arrays and FPowers go to shared memory,
+    # every other value travels in the spec
+
+    def __init__(self, model):
+
+        arrays = {}
+        powers = {}
+        values = {}
+        blocks = []
+        size = 0
+
+        def place(array):
+            nonlocal size
+            array = np.ascontiguousarray(array)
+            offset = size
+            size += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+            blocks.append((offset, array))
+            return offset, np.shape(array), array.dtype.str
+
+        for key, value in model.items():
+            if isinstance(value, FPowers):
+                powers[key] = ({name: place(array) for name, array in value.arrays().items()}, value.size,
+                               value.strategy, value.cache_size)
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                arrays[key] = place(value)
+            else:
+                values[key] = value
+
+        reclaim_stale_bundles()
+
+        self._memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        os.makedirs(REGISTRY, exist_ok=True)
+        entry = os.path.join(REGISTRY, self._memory.name.lstrip('/'))
+        with open(entry, 'w') as f:
+            f.write(str(os.getpid()))
+        for offset, array in blocks:
+            np.ndarray(np.shape(array), array.dtype, self._memory.buf, offset)[...] = array
+
+        self.spec = BundleSpec(self._memory.name, arrays, powers, values)
+        self.nbytes = size
+        self._finalizer = weakref.finalize(self, _release, self._memory, entry)
+
+    def close(self):
+
+        self._finalizer()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+
+def attach(spec):
+
+    # The model of a BundleSpec with read-only views of the shared arrays, and the
+    # SharedMemory handle, which has to be kept as long as the views are in use
+
+    memory = shared_memory.SharedMemory(name=spec.name)
+
+    def view(entry):
+        offset, shape, dtype = entry
+        array = np.ndarray(shape, np.dtype(dtype), memory.buf, offset)
+        array.setflags(write=False)
+        return array
+
+    model = dict(spec.values)
+    model.update({key: view(entry) for key, entry in spec.arrays.items()})
+    for key, (entries, size, strategy, cache_size) in spec.powers.items():
+        model[key] = FPowers.from_arrays({name: view(entry) for name, entry in entries.items()}, size, strategy,
+                                         cache_size)
+
+    return model, memory
+
+
+# Crash check
+
+def main():
+
+    # Kills a process holding a bundle while its pool worker lives on, as a parent
+    # killed during a sweep, then checks that creating the next bundle unlinks the block
+
+    code = ('import sys, os, time, concurrent.futures; sys.path.insert(0, '
+            + repr(os.path.dirname(os.path.abspath(__file__))) + '); '
+            'import numpy as np; from bundle import ModelBundle, attach; '
+            'bundle = ModelBundle(dict(x=np.ones(1000))); '
+            'executor = concurrent.futures.ProcessPoolExecutor(1, initializer=attach, initargs=(bundle.spec,)); '
+            'print(bundle.spec.name, executor.submit(os.getpid).result(), flush=True); time.sleep(600)')
+    child = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+    name, worker = child.stdout.readline().split()
+    os.kill(child.pid, signal.SIGKILL)
+    child.wait()
+    time.sleep(1)
+
+    try:
+        shared_memory.SharedMemory(name=name).close()
+        print('Block ' + name + ' outlived the killed process')
+        with ModelBundle(dict(x=np.ones(1))):
+            pass
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        print('Block ' + name + ' of the killed process was reclaimed')
+        return
+    finally:
+        os.kill(int(worker), signal.SIGKILL)
+
+    print('Block ' + name + ' of the killed process is still there')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
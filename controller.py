@@ -0,0 +1,320 @@
+from model import *
+from _PARAMETERS import *
+import numpy as np
+import argparse
+import time
+
+
+# Streaming controllers
+
+class SelfTuningController:
+
+    # Per-step counterpart of run_fix_lqr_robot (lam=None, self-tuning) and
+    # run_lqr_robot (fixed lam) built from the precomputed P, D, H and F.
+    #
+    # Predictions of the perturbations are kept by absolute time slot. The
+    # feedforward G_s = P w_s + F^T G_{s+1} is cached and only the slots from t
+    # to the latest changed prediction are recomputed, at O(n^2) each. Without
+    # new predictions a step costs O(n^2); with a rolling window, where each step
+    # predicts one more slot at the far end, every slot from t to that end is
+    # recomputed and a step costs O(lookahead n^2). The realized
+    # perturbation w_{t-1} = x_t - A x_{t-1} - B u_{t-1} is recovered from the
+    # new state and fed to the online lambda, which therefore uses data up to t - 1.
+
+    def __init__(self, A, B, P, D, H, F, ini_lambda=0.3, lam=None, capacity=256):
+
+        self.A = A
+        self.B = B
+        self.P = P
+        self.D = D
+        self.F = F
+        self.lam = lam
+        self.estimator = FTLLambda(P, F, H, ini_lambda, clip=True)
+
+        self.t = 0
+        self._K = np.matmul(D, np.matmul(P, A))
+        self._offset = 0
+        self._end = 0
+        self._dirty = -1
+        self._predictions = np.zeros((capacity, np.shape(A)[0]))
+        self._G = np.zeros((capacity + 1, np.shape(A)[0]))
+        self._x = None
+        self._u = None
+        self._prediction = None
+
+    def _reserve(self, end):
+
+        # Grow the buffers to hold slots below end, dropping slots before t
+
+        if end - self._offset <= np.shape(self._predictions)[0]:
+            return
+
+        keep = max(self._end, end) - self.t
+        capacity = max(2 * keep, np.shape(self._predictions)[0])
+        predictions = np.zeros((capacity, np.shape(self.A)[0]))
+        G = np.zeros((capacity + 1, np.shape(self.A)[0]))
+
+        live = self._end - self.t
+        if live > 0:
+            predictions[:live] = self._predictions[self.t - self._offset:self._end - self._offset]
+            G[:live] = self._G[self.t - self._offset:self._end - self._offset]
+
+        self._predictions = predictions
+        self._G = G
+        self._offset = self.t
+
+    def update_predictions(self, start, predictions):
+
+        # Overwrite the predicted perturbations of slots start, start + 1, ...
+
+        predictions = np.atleast_2d(predictions)
+
+        # Slots already acted on are ignored
+        if start < self.t:
+            predictions = predictions[self.t - start:]
+            start = self.t
+
+        end = start + np.shape(predictions)[0]
+
+        if end <= start:
+            return
+
+        self._reserve(end)
+        self._predictions[start - self._offset:end - self._offset] = predictions
+
+        if end > self._end:
+            self._G[self._end - self._offset:end - self._offset + 1] = 0
+            self._end = end
+        self._dirty = max(self._dirty, end - 1)
+
+    def _feedforward(self):
+
+        if self._dirty >= self.t:
+            for s in range(self._dirty, self.t - 1, -1):
+                i = s - self._offset
+                self._G[i] = np.matmul(self.P, self._predictions[i]) + np.matmul(self._G[i + 1], self.F)
+            self._dirty = self.t - 1
+
+        if self.t >= self._end:
+            return np.zeros(np.shape(self.A)[0])
+
+        return self._G[self.t - self._offset]
+
+    def step(self, x, predictions=None):
+
+        # predictions, if given, are the perturbations predicted for slots t, t + 1, ...
+
+        if self._x is not None:
+            w = x - np.matmul(self.A, self._x) - np.matmul(self.B, self._u)
+            self.estimator.update(w, self._prediction)
+
+        if predictions is not None:
+            self.update_predictions(self.t, predictions)
+
+        G = self._feedforward()
+        lam = self.estimator.lam() if self.lam is None else self.lam
+        u = -np.matmul(self._K, x) - lam * np.matmul(self.D, G)
+
+        # Copied, so callers may update their state in place
+        self._x = np.array(x)
+        self._u = u
+        self._prediction = self._predictions[self.t - self._offset].copy() if self.t < self._end else np.zeros(
+            np.shape(x))
+        self.t += 1
+
+        return u
+
+
+class _RowFTLLambda(FTLLambda):
+
+    # FTLLambda whose Gamma carries a leading axis of controllers, which may be at
+    # different steps
+
+    def _apply(self, x, M):
+
+        return np.einsum('...ij,...j->...i', M, x)
+
+
+_ESTIMATOR_STATE = ('_gamma', '_V_w', '_V_est_w', '_prediction_prediction', '_prediction_perturbation',
+                    '_diagonal_prediction', '_diagonal_perturbation')
+
+
+class ControllerBank:
+
+    # Many SelfTuningControllers of one system, stepped together: a step of any subset
+    # of them is a handful of matrix products over their stacked states. Controller c
+    # at its slot t_c is given the predictions of slots t_c, ..., t_c + lookahead - 1,
+    # so its feedforward is truncated to that window; with the same windows fed through
+    # update_predictions, SelfTuningController returns the same actions. Diagonal
+    # systems (vector P, see get_diagonal_gains) are stepped elementwise.
+
+    def __init__(self, A, B, P, D, H, F, lookahead, ini_lambda=0.3, lam=None, capacity=1024):
+
+        self.A = A
+        self.B = B
+        self.D = D
+        self.lookahead = lookahead
+        self.lam = lam
+        self.diagonal = np.ndim(P) == 1
+        self.size = 0
+
+        n = np.shape(A)[0]
+        self._m = n if self.diagonal else np.shape(B)[1]
+
+        # G_t = sum_k (F^T)^k P w_{t + k}, as one product with the flattened prediction window
+        if self.diagonal:
+            self._K = D * P * A
+            self._window = P * F ** np.arange(lookahead)[:, np.newaxis]
+            self._estimator = DiagonalFTLLambda(P, F, H, ini_lambda, clip=True)
+        else:
+            self._K = np.matmul(D, np.matmul(P, A))
+            self._window = np.concatenate([np.matmul(P, np.linalg.matrix_power(F, k)) for k in range(lookahead)])
+            self._estimator = _RowFTLLambda(P, F, H, ini_lambda, clip=True)
+
+        self.t = np.zeros(0, dtype=int)
+        self._x = np.zeros((0, n))
+        self._u = np.zeros((0, self._m))
+        self._prediction = np.zeros((0, n))
+        for name in _ESTIMATOR_STATE:
+            setattr(self._estimator, name, np.zeros((0,) + (np.shape(P) if name == '_gamma' else
+                                                           (n,) if name.startswith('_V') else ())))
+        self._reserve(capacity)
+
+    def _reserve(self, capacity):
+
+        if capacity <= len(self.t):
+            return
+
+        def grow(a):
+            grown = np.zeros((capacity,) + np.shape(a)[1:], dtype=a.dtype)
+            grown[:len(a)] = a
+            return grown
+
+        self.t = grow(self.t)
+        self._x = grow(self._x)
+        self._u = grow(self._u)
+        self._prediction = grow(self._prediction)
+        for name in _ESTIMATOR_STATE:
+            setattr(self._estimator, name, grow(getattr(self._estimator, name)))
+
+    def add(self, count=1):
+
+        # Ids of count new controllers, starting at slot 0
+
+        if self.size + count > len(self.t):
+            self._reserve(max(2 * len(self.t), self.size + count))
+
+        self.size += count
+
+        return np.arange(self.size - count, self.size)
+
+    def _update_lambda(self, rows, w, estimated_w):
+
+        # FTLLambda.update on the rows of the stacked estimator state
+
+        state = {name: getattr(self._estimator, name) for name in _ESTIMATOR_STATE}
+        for name in _ESTIMATOR_STATE:
+            setattr(self._estimator, name, state[name][rows])
+
+        self._estimator.update(w, estimated_w)
+
+        for name in _ESTIMATOR_STATE:
+            state[name][rows] = getattr(self._estimator, name)
+            setattr(self._estimator, name, state[name])
+
+    def step(self, ids, x, predictions):
+
+        # ids (b,) distinct controllers, x (b, n) their states and predictions
+        # (b, lookahead, n) the predicted perturbations of their next slots; returns the
+        # actions (b, m) and the trust parameters used (b,)
+
+        ids = np.asarray(ids)
+
+        # Realized perturbations w_{t - 1} = x_t - A x_{t - 1} - B u_{t - 1} feed the online lambda
+        started = ids[self.t[ids] > 0]
+        if len(started):
+            x_started = x[self.t[ids] > 0]
+            if self.diagonal:
+                w = x_started - self.A * self._x[started] - self.B * self._u[started]
+            else:
+                w = (x_started - np.matmul(self._x[started], np.transpose(self.A))
+                     - np.matmul(self._u[started], np.transpose(self.B)))
+            self._update_lambda(started, w, self._prediction[started])
+
+        if self.lam is None:
+            lam = self._estimator._ratio(self._estimator._prediction_perturbation[ids],
+                                         self._estimator._prediction_prediction[ids])
+        else:
+            lam = self.lam * np.ones(len(ids))
+
+        if self.diagonal:
+            G = np.einsum('bkn,kn->bn', predictions, self._window)
+            u = -self._K * x - lam[:, np.newaxis] * self.D * G
+        else:
+            G = np.matmul(np.reshape(predictions, (len(ids), -1)), self._window)
+            u = -np.matmul(x, np.transpose(self._K)) - lam[:, np.newaxis] * np.matmul(G, np.transpose(self.D))
+
+        self._x[ids] = x
+        self._u[ids] = u
+        self._prediction[ids] = predictions[:, 0]
+        self.t[ids] += 1
+
+        return u, lam
+
+
+# Microbenchmark
+
+def benchmark_step(controller, A, B, w, estimated_w, lookahead):
+
+    # Closed loop with a rolling prediction window; returns per-step latencies in seconds
+
+    T = np.shape(w)[0]
+    x = np.zeros(np.shape(A)[0])
+    latencies = np.zeros(T)
+
+    controller.update_predictions(0, estimated_w[:lookahead])
+
+    for t in range(T):
+        start = time.perf_counter()
+        # The window advances by one slot: the prediction of its far end arrives
+        if t > 0:
+            controller.update_predictions(t + lookahead - 1, estimated_w[t + lookahead - 1:t + lookahead])
+        u = controller.step(x)
+        latencies[t] = time.perf_counter() - start
+        x = np.matmul(A, x) + np.matmul(B, u) + w[t]
+
+    return latencies
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Step latency of the streaming self-tuning controller')
+
+    parser.add_argument('--mode', default='Tracking', type=str,
+                        help='Tracking or EV')
+    parser.add_argument('--T', default=2000,
+                        type=int, help='Number of time slots')
+    parser.add_argument('--lookahead', default=50,
+                        type=int, help='Number of predicted slots available at each step')
+    parser.add_argument('--sigma', default=0.01,
+                        type=float, help='Scale of the Binomial prediction error')
+
+    configs = parser.parse_args()
+
+    A, B, Q, R, _, _, mu = generate_parameters(configs.mode, 1, 1)
+
+    P, D, H, F = get_gains(A, B, Q, R)[:4]
+
+    w = generate_w(configs.mode, A, configs.T + configs.lookahead)
+    estimated_w = w + generate_noise(mu, configs.sigma, configs.T + configs.lookahead, A, 'Binomial')
+
+    controller = SelfTuningController(A, B, P, D, H, F)
+    latencies = benchmark_step(controller, A, B, w[:configs.T], estimated_w, configs.lookahead)
+
+    print('Steps: ' + str(configs.T))
+    print('p50 step latency (us): ' + str(round(1e6 * np.percentile(latencies, 50), 2)))
+    print('p99 step latency (us): ' + str(round(1e6 * np.percentile(latencies, 99), 2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+from model import *
+from sweep import run_sweep
+from instrument import logger
+import numpy as np
+
+
+# Sweeps over families of systems
+#
+# The members of a family, e.g. the Q/R scalings of _PARAMETERS.scale_family, share
+# the perturbations, the sigma grid and the seed, so they all see the same prediction
+# errors. Their gains come from one batched Riccati solve (get_family_gains, or the
+# closed form for diagonals) and every member is then swept as a single system.
+
+def family_sweep(model, A, B, Q, R, N, M, seed, workers=1, powers='auto', progress_interval=5.0):
+
+    # model as for run_sweep without the system and its gains; A, B, Q and R stack the
+    # members along a leading axis, as matrices or, for diagonal systems, as diagonals.
+    # Returns the outputs of run_sweep stacked over the members
+
+    count = len(A)
+    diagonal = np.ndim(A) == 2
+
+    if diagonal:
+        family = get_diagonal_gains(A, B, Q, R)
+    else:
+        family = get_family_gains(A, B, Q, R)
+    logger.info('Gains of %d systems solved', count)
+
+    outputs = []
+
+    for k in range(count):
+
+        if diagonal:
+            gains = None
+            P, D, H, F = (value[k] for value in family)
+        else:
+            gains = family[k]
+            P, D, H, F = gains.P, gains.D, gains.H, FPowers(gains.F, model['T'] + 1, powers)
+
+        member = dict(model, A=A[k], B=B[k], Q=Q[k], R=R[k], P=P, D=D, H=H, F=F, gains=gains)
+        outputs.append(run_sweep(member, N, M, seed, workers, progress_interval=progress_interval))
+        logger.info('System %d of %d: self-tuning competitive ratio at most %.4g', k + 1, count,
+                    np.max(outputs[-1][1]))
+
+    return tuple(np.array(output) for output in zip(*outputs))
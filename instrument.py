@@ -0,0 +1,115 @@
+import contextlib
+import json
+import logging
+import time
+
+
+logger = logging.getLogger('lqc')
+
+
+# Per-phase timers and counters
+
+class _Phase:
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+
+class Profiler:
+
+    # Accumulates wall time and call counts per phase. While disabled, phase()
+    # hands out one shared no-op context manager and count() returns at once.
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    def phase(self, name):
+
+        if not self.enabled:
+            return _NULL_PHASE
+
+        return _Phase(self, name)
+
+    def add(self, name, seconds, calls=1):
+
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, n=1):
+
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    def report(self):
+
+        return dict(phases={name: dict(seconds=self.seconds[name], calls=self.calls[name]) for name in self.seconds},
+                    counters=dict(self.counters))
+
+    def merge(self, report):
+
+        # Fold in the report of another profiler, e.g. from a sweep worker
+
+        for name, phase in report['phases'].items():
+            self.add(name, phase['seconds'], phase['calls'])
+        for name, n in report['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def save(self, path):
+
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+_NULL_PHASE = contextlib.nullcontext()
+
+PROFILER = Profiler()
+
+
+# Rate-limited progress reporting
+
+class Progress:
+
+    def __init__(self, total, description, interval=5.0):
+
+        self.total = total
+        self.description = description
+        self.interval = interval
+        self.done = 0
+        self._start = time.perf_counter()
+        self._last = None
+
+    def update(self, n=1, message=''):
+
+        self.done += n
+        now = time.perf_counter()
+
+        if self._last is not None and now - self._last < self.interval and self.done < self.total:
+            return
+
+        self._last = now
+        elapsed = now - self._start
+        remaining = elapsed / self.done * (self.total - self.done) if self.done else float('nan')
+        logger.info('%s %d/%d (%.0f%%) %s elapsed %.1fs, remaining ~%.1fs', self.description, self.done, self.total,
+                    100.0 * self.done / max(self.total, 1), message, elapsed, remaining)
@@ -0,0 +1,160 @@
+from model import *
+from instrument import PROFILER
+import numpy as np
+import hashlib
+import os
+
+
+# Memoized simulation runs
+#
+# Each result is stored as <directory>/<key>.npz, where the key hashes the function,
+# the system matrices, mode, T, the noise realization and the policy parameters.
+# Reads refresh a file's modification time, and the least recently used files are
+# evicted once the directory grows past max_bytes.
+
+class RunCache:
+
+    def __init__(self, directory, max_bytes=1 << 30):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npz')]
+
+    def key(self, name, *parts):
+
+        digest = hashlib.sha256(name.encode())
+
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(array_digest(part).encode())
+            else:
+                digest.update(repr(part).encode())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+
+        path = os.path.join(self.directory, key + '.npz')
+
+        try:
+            with np.load(path) as data:
+                values = tuple(data['value_' + str(i)][()] for i in range(len(data.files)))
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            PROFILER.count('run_cache_misses')
+            return None
+
+        self.hits += 1
+        PROFILER.count('run_cache_hits')
+
+        return values
+
+    def put(self, key, values):
+
+        path = os.path.join(self.directory, key + '.npz')
+        temporary = path + '.' + str(os.getpid()) + '.tmp.npz'
+
+        np.savez(temporary, **{'value_' + str(i): value for i, value in enumerate(values)})
+        self._size += os.path.getsize(temporary)
+        os.replace(temporary, path)
+
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+
+        # Drop least recently used entries until the store is below 90% of its budget
+
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+
+        for entry in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._size -= size
+            except OSError:
+                pass
+
+
+def cached_fix_lqr_robot(cache, T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead=None):
+
+    if cache is None:
+        return run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, False, lookahead)
+
+    key = cache.key('run_fix_lqr_robot', A, B, Q, R, mode, T, noise, ini_lambda, lookahead)
+    values = cache.get(key)
+
+    if values is None:
+        values = run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, False, lookahead)
+        cache.put(key, values)
+
+    return values
+
+
+def cached_lqr_cost_coefficients(cache, T, A, B, Q, R, noise, mode, P, D, H, F, lookahead=None):
+
+    # The coefficients price every lambda, so changing the lambda grid never misses
+
+    if cache is None:
+        return lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead)
+
+    key = cache.key('lqr_cost_coefficients', A, B, Q, R, mode, T, noise, lookahead)
+    values = cache.get(key)
+
+    if values is None:
+        values = (lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead),)
+        cache.put(key, values)
+
+    return values[0]
+
+
+def cached_batch_runs(cache, T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead=None):
+
+    # run_batch_fix_lqr_robot and batch_lqr_cost_coefficients memoized per realization,
+    # simulating only the rows of noise that have not been seen before
+
+    if cache is None:
+        return (run_batch_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead),
+                batch_lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead))
+
+    M = np.shape(noise)[0]
+    fix_keys = [cache.key('run_fix_lqr_robot', A, B, Q, R, mode, T, noise[m], ini_lambda, lookahead)
+                for m in range(M)]
+    coefficient_keys = [cache.key('lqr_cost_coefficients', A, B, Q, R, mode, T, noise[m], lookahead)
+                        for m in range(M)]
+
+    outputs = np.zeros((M, 7))
+    coefficients = np.zeros((M, 3))
+    missing = []
+
+    for m in range(M):
+        fix_values = cache.get(fix_keys[m])
+        coefficient_values = cache.get(coefficient_keys[m])
+        if fix_values is None or coefficient_values is None:
+            missing.append(m)
+        else:
+            outputs[m] = fix_values
+            coefficients[m] = coefficient_values[0]
+
+    if missing:
+        outputs[missing] = np.transpose(run_batch_fix_lqr_robot(T, A, B, Q, R, noise[missing], mode, P, D, H, F,
+                                                                ini_lambda, lookahead))
+        coefficients[missing] = batch_lqr_cost_coefficients(T, A, B, Q, R, noise[missing], mode, P, D, H, F,
+                                                            lookahead)
+        for m in missing:
+            cache.put(fix_keys[m], tuple(outputs[m]))
+            cache.put(coefficient_keys[m], (coefficients[m],))
+
+    return tuple(np.transpose(outputs)), coefficients
@@ -1,15 +1,17 @@
 import numpy as np
-import math
-import control
+import collections
+import hashlib
+import logging
+import os
 import random
-from plots import *
+from instrument import PROFILER, logger
 
 # Define trackings
 
 def tracking_coordinates(t):
 
-    y_1 = 2 * math.cos(t/38.2) + math.cos(5 * t/38.2)
-    y_2 = 2 * math.sin(t/38.2) + math.sin(5 * t/38.2)
+    y_1 = 2 * np.cos(t/38.2) + np.cos(5 * t/38.2)
+    y_2 = 2 * np.sin(t/38.2) + np.sin(5 * t/38.2)
 
     return y_1, y_2
 
@@ -40,136 +42,949 @@ def _get_K(F, P, H):
     return K
 
 
-def compute_upper_bound(A, B, Q, R, OPT, lam, epsilon, X, Y, W, Z):
+# Riccati solution and gains, cached by the content of (A, B, Q, R)
+
+Gains = collections.namedtuple('Gains', ['P', 'D', 'H', 'F', 'K', 'eig_K', 'norm_H', 'norm_P'])
+
+_GAINS_CACHE = collections.OrderedDict()
+_GAINS_CACHE_SIZE = 32
+
+
+def array_digest(*arrays):
+
+    digest = hashlib.sha256()
+
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+
+# Block-diagonal structure: only the Riccati solve splits into blocks. Simulation is
+# elementwise for fully diagonal systems (diagonal_structure); a system with larger
+# blocks keeps its dense gains and is simulated with dense products
+
+def block_structure(A, B, Q, R):
+
+    # Independent subsystems of (A, B, Q, R) as a list of (state indices, input indices):
+    # connected components of the graph coupling states through A and Q, inputs through R
+    # and states to inputs through B
+
+    from scipy.sparse.csgraph import connected_components
+
+    n = np.shape(A)[0]
+    coupling = np.zeros((n + np.shape(B)[1], n + np.shape(B)[1]), dtype=bool)
+    coupling[:n, :n] = (A != 0) | (np.transpose(A) != 0) | (Q != 0) | (np.transpose(Q) != 0)
+    coupling[:n, n:] = B != 0
+    coupling[n:, :n] = np.transpose(B != 0)
+    coupling[n:, n:] = (R != 0) | (np.transpose(R) != 0)
+
+    count, labels = connected_components(coupling, directed=False)
+
+    return [(np.flatnonzero(labels[:n] == c), np.flatnonzero(labels[n:] == c)) for c in range(count)]
+
+
+def diagonal_structure(A, B, Q, R):
+
+    # The diagonals (a, b, q, r) if the system is n independent scalar systems, else None
+
+    if np.shape(B) != np.shape(A):
+        return None
+
+    for M in (A, B, Q, R):
+        if np.count_nonzero(M - np.diag(np.diagonal(M))):
+            return None
+
+    return np.diagonal(A).copy(), np.diagonal(B).copy(), np.diagonal(Q).copy(), np.diagonal(R).copy()
+
+
+def _scalar_riccati(a, b, q, r):
+
+    # Stabilizing root of b^2 p^2 + (r (1 - a^2) - q b^2) p - q r = 0, the scalar DARE,
+    # elementwise; the two forms avoid cancellation for either sign of the linear term
+
+    beta = r * (1 - a ** 2) - q * b ** 2
+    root = np.sqrt(beta ** 2 + 4 * b ** 2 * q * r)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(beta <= 0, (root - beta) / (2 * b ** 2), 2 * q * r / (root + beta))
+
+
+def _solve_riccati(A, B, Q, R):
+
+    # P solved block by block: scalar blocks in closed form, larger ones through
+    # control.dare, which is only needed then and slow to import. The P returned is
+    # dense, as are the gains and the simulation built on it
+
+    blocks = [(states, inputs) for states, inputs in block_structure(A, B, Q, R) if len(states)]
+
+    if len(blocks) > 1 and all(len(inputs) for _, inputs in blocks):
+
+        P = np.zeros(np.shape(A))
+        scalar = [(states[0], inputs[0]) for states, inputs in blocks if len(states) == 1 and len(inputs) == 1]
+
+        if scalar:
+            s, u = (np.array(index) for index in zip(*scalar))
+            P[s, s] = _scalar_riccati(A[s, s], B[s, u], Q[s, s], R[u, u])
+
+        for states, inputs in blocks:
+            if len(states) > 1 or len(inputs) > 1:
+                P[np.ix_(states, states)] = _solve_riccati(A[np.ix_(states, states)], B[np.ix_(states, inputs)],
+                                                           Q[np.ix_(states, states)], R[np.ix_(inputs, inputs)])
+
+        return P
+
+    import control
 
     P, _, _ = control.dare(A, B, Q, R)
+
+    return P
+
+
+def _solve_gains(A, B, Q, R):
+
+    P = _solve_riccati(A, B, Q, R)
     D = _get_D(B, P, R)
     H = _get_H(B, D)
     F = _get_F(A, P, H)
-    K = _get_K(F,P,H)
-    w, _ = np.linalg.eig(K)
 
-    bound_1 = 1 + np.linalg.norm(H, 2) * (
-            (lam ** 2) * (epsilon) / OPT + Z * ((1 - lam) ** 2) / OPT + Y * (1 - lam) * lam / OPT)
-    bound_2 = 1 + np.linalg.norm(H, 2) * (Z / OPT + (lam ** 2) * W / (OPT) + X * (1 - lam) * lam / OPT)
+    try:
+        K = _get_K(F, P, H)
+        eig_K = np.linalg.eigvals(K)
+    except np.linalg.LinAlgError:
+        K = np.full(np.shape(P), np.nan)
+        eig_K = np.full(np.shape(P)[0], np.nan)
 
-    return min(bound_1, bound_2)
+    return Gains(P, D, H, F, K, eig_K, np.linalg.norm(H, 2), np.linalg.norm(P, 2))
 
 
-def generate_noise(mu, sigma, T, A, type):
-    noise = np.zeros((T, np.shape(A)[0]))
+def get_gains(A, B, Q, R, cache_dir=None):
 
-    for t in range(T):
+    # In-process LRU first, then <cache_dir>/gains/<digest>.npz if a directory is
+    # given (or set through LQC_CACHE_DIR), then a fresh DARE solve
 
-        if type == 'Gaussian':
+    key = array_digest(A, B, Q, R)
 
-            noise[t] = np.random.normal(mu, 0.005, np.shape(A)[0])
+    if key in _GAINS_CACHE:
+        _GAINS_CACHE.move_to_end(key)
+        return _GAINS_CACHE[key]
 
-        elif type == 'Binomial':
+    cache_dir = cache_dir if cache_dir is not None else os.environ.get('LQC_CACHE_DIR')
+    path = os.path.join(cache_dir, 'gains', key + '.npz') if cache_dir else None
 
-            noise[t] = sigma * np.random.binomial(10, 0.5, np.shape(A)[0])
-        else:
+    if path is not None and os.path.exists(path):
+        with np.load(path) as data:
+            gains = Gains(*(data[field] for field in Gains._fields))
+    else:
+        gains = _solve_gains(np.asarray(A), np.asarray(B), np.asarray(Q), np.asarray(R))
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = path + '.' + str(os.getpid()) + '.tmp.npz'
+            np.savez(temporary, **gains._asdict())
+            os.replace(temporary, path)
+
+    prime_gains(A, B, Q, R, gains)
+
+    return gains
+
+
+def prime_gains(A, B, Q, R, gains):
+
+    # Installs gains solved elsewhere, e.g. by get_family_gains, as the result of
+    # get_gains(A, B, Q, R)
+
+    for array in gains:
+        if isinstance(array, np.ndarray):
+            array.setflags(write=False)
+
+    _GAINS_CACHE[array_digest(A, B, Q, R)] = gains
+    if len(_GAINS_CACHE) > _GAINS_CACHE_SIZE:
+        _GAINS_CACHE.popitem(last=False)
+
+
+DiagonalGains = collections.namedtuple('DiagonalGains', ['P', 'D', 'H', 'F'])
+
+
+def get_diagonal_gains(a, b, q, r):
+
+    # Gains of n independent scalar systems as vectors, the diagonals of P, D, H and F
+
+    p = _scalar_riccati(a, b, q, r)
+    d = b / (r + b ** 2 * p)
+    h = b * d
+
+    return DiagonalGains(p, d, h, a - h * p * a)
+
+
+# Riccati solutions of families of systems
+#
+# Members of a family share their shapes and are stacked along a leading axis, so one
+# iteration advances all of them with batched matrix products. With R positive
+# definite, structured doubling converges quadratically from scratch; otherwise
+# (Tracking, R = 0) every member runs Newton's iteration from the solution of its
+# nearest solved neighbour in the family.
+
+def _transpose(M):
+
+    return np.swapaxes(M, -1, -2)
+
+
+def _family_norm(M):
+
+    return np.linalg.norm(M, axis=(-2, -1))
+
+
+def _family_sda(A, B, Q, R, tol, max_iter):
+
+    # Structured doubling (Chu, Fan and Lin): H_k -> P and A_k -> 0 quadratically.
+    # Returns P and the members that converged
+
+    I = np.eye(np.shape(A)[-1])
+    G = np.matmul(B, np.linalg.solve(R, _transpose(B)))
+    H = np.array(Q, dtype=float)
+    A = np.array(A, dtype=float)
+    converged = np.zeros(len(A), dtype=bool)
+    active = np.arange(len(A))
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for k in range(max_iter):
+
+            if not len(active):
+                break
+
+            a, g, h = A[active], G[active], H[active]
             try:
-                print(type)
-                print('Noise type is not supported!')
-            except:
-                print("A type error occured")
+                W = I + np.matmul(g, h)
+                WA = np.linalg.solve(W, a)
+                WG = np.linalg.solve(W, g)
+            except np.linalg.LinAlgError:
+                break
+
+            step = np.matmul(_transpose(a), np.matmul(h, WA))
+            H[active] = h + step
+            G[active] = g + np.matmul(a, np.matmul(WG, _transpose(a)))
+            A[active] = np.matmul(a, WA)
+
+            # Members that converged or blew up stop iterating
+            change = _family_norm(step)
+            done = change <= tol * _family_norm(H[active])
+            converged[active[done]] = True
+            active = active[~done & np.isfinite(change)]
+
+    return (H + _transpose(H)) / 2, converged
+
+
+def _family_stein(A, C, tol, max_iter):
+
+    # X = A^T X A + C by Smith's doubling, X_{k+1} = X_k + (A^{2^k})^T X_k A^{2^k}.
+    # Returns X and the members that converged, those whose A is stable
+
+    X = np.array(C, dtype=float)
+    converged = np.zeros(len(A), dtype=bool)
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for k in range(max_iter):
+            step = np.matmul(_transpose(A), np.matmul(X, A))
+            X = X + step
+            converged = _family_norm(step) <= tol * _family_norm(X)
+            if np.all(converged | ~np.isfinite(X).all(axis=(-2, -1))):
+                break
+            A = np.matmul(A, A)
+
+    return X, converged
+
+
+def _family_newton(A, B, Q, R, P, tol, max_iter):
+
+    # Hewer's iteration from P: the gain K of P, then the cost of K from the Stein
+    # equation P = (A - B K)^T P (A - B K) + Q + K^T R K. It converges quadratically once
+    # the gain of the start stabilizes the member. Returns P and the converged members
+
+    converged = np.zeros(len(A), dtype=bool)
+    failed = np.zeros(len(A), dtype=bool)
+
+    for k in range(max_iter):
+
+        try:
+            K = np.linalg.solve(R + np.matmul(_transpose(B), np.matmul(P, B)),
+                                np.matmul(_transpose(B), np.matmul(P, A)))
+        except np.linalg.LinAlgError:
+            return P, np.zeros(len(A), dtype=bool)
+
+        P_next, stable = _family_stein(A - np.matmul(B, K), Q + np.matmul(_transpose(K), np.matmul(R, K)), tol,
+                                       max_iter)
+        failed |= ~stable
+        converged = _family_norm(P_next - P) <= tol * _family_norm(P_next)
+        P = np.where(failed[:, np.newaxis, np.newaxis], P, (P_next + _transpose(P_next)) / 2)
+
+        if np.all(converged | failed):
+            break
+
+    return P, converged & ~failed
+
+
+def solve_riccati_family(A, B, Q, R, tol=1e-12, max_iter=64):
+
+    # P of every member of a family stacked as (K, n, n), (K, n, m), (K, n, n) and
+    # (K, m, m). Members no batched iteration solves, and the first member when no warm
+    # start is available yet, are solved on their own by _solve_riccati
+
+    A, B, Q, R = (np.asarray(M, dtype=float) for M in (A, B, Q, R))
+    count = len(A)
+    P = np.zeros(np.shape(Q))
+    solved = np.zeros(count, dtype=bool)
+
+    with PROFILER.phase('riccati_family'):
+
+        # Doubling for the members with R positive definite, refined by Newton's iteration,
+        # which removes the rounding errors doubling accumulates
+        definite = np.flatnonzero(np.all(np.linalg.eigvalsh((R + _transpose(R)) / 2) > 0, axis=-1))
+        if len(definite):
+            P[definite], converged = _family_sda(A[definite], B[definite], Q[definite], R[definite], tol, max_iter)
+            definite = definite[converged]
+            P[definite], converged = _family_newton(A[definite], B[definite], Q[definite], R[definite], P[definite],
+                                                    tol, max_iter)
+            solved[definite[converged]] = True
+
+        while not np.all(solved):
+
+            rest = np.flatnonzero(~solved)
+
+            if np.any(solved):
+                done = np.flatnonzero(solved)
+                nearest = done[np.argmin(np.abs(rest[:, np.newaxis] - done), axis=1)]
+                P[rest], converged = _family_newton(A[rest], B[rest], Q[rest], R[rest], P[nearest], tol, max_iter)
+                solved[rest[converged]] = True
+                rest = rest[~converged]
+
+            # The first member left is solved on its own and warm-starts its neighbours
+            if len(rest):
+                k = rest[0]
+                P[k] = _solve_riccati(A[k], B[k], Q[k], R[k])
+                solved[k] = True
+                PROFILER.count('riccati_family_single')
+
+    return P
+
+
+def get_family_gains(A, B, Q, R, tol=1e-12, max_iter=64):
+
+    # Gains of every member of a stacked family, as a list of Gains
+
+    P = solve_riccati_family(A, B, Q, R, tol, max_iter)
+    A, B, Q, R = (np.asarray(M, dtype=float) for M in (A, B, Q, R))
+
+    D = np.linalg.solve(R + np.matmul(_transpose(B), np.matmul(P, B)), _transpose(B))
+    H = np.matmul(B, D)
+    F = A - np.matmul(H, np.matmul(P, A))
+
+    family = []
+    for k in range(len(A)):
+        try:
+            K = _get_K(F[k], P[k], H[k])
+            eig_K = np.linalg.eigvals(K)
+        except np.linalg.LinAlgError:
+            K = np.full(np.shape(P[k]), np.nan)
+            eig_K = np.full(np.shape(P[k])[0], np.nan)
+        family.append(Gains(P[k], D[k], H[k], F[k], K, eig_K, np.linalg.norm(H[k], 2), np.linalg.norm(P[k], 2)))
+
+    return family
+
+
+# Powers of F
+
+def _get_power_norms(F, T):
+
+    # ||F^k||_2 for k < T, holding a single power at a time. Once a norm is below
+    # machine precision of ||F^0|| = 1 the rest are left at zero: rounding keeps the
+    # powers of a stable F from vanishing exactly, and ||F^{k+j}|| <= ||F^k|| ||F^j||
+
+    norms = np.zeros(T)
+    power = np.eye(np.shape(F)[0])
+
+    for k in range(T):
+        norms[k] = np.linalg.norm(power, 2)
+        if norms[k] <= np.finfo(float).eps * norms[0]:
+            norms[k] = 0
+            break
+        power = np.matmul(power, F)
+
+    return norms
+
+
+class FPowers:
+
+    # Sequence-like access to F^0, ..., F^{size - 1} without storing the list.
+    #
+    # strategy 'dense' precomputes every power (the former F_list), 'eig' uses
+    # F^k = V diag(e^k) V^{-1} when F is diagonalizable with a well-conditioned V,
+    # 'squaring' builds single powers from cached F^{2^j}, and 'matvec' applies F
+    # k times in rmatvec, so the truncated feedforward never forms F^k. 'auto' picks
+    # 'eig' when it is safe, else 'squaring'.
+
+    def __init__(self, F, size, strategy='auto', cache_size=64, max_condition=1e8):
+
+        self.F = np.asarray(F)
+        self.size = size
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._norms = np.zeros(0)
+
+        if strategy == 'auto' or strategy == 'eig':
+            e, V = np.linalg.eig(self.F)
+            if np.linalg.cond(V) < max_condition:
+                self._e = e
+                self._V = V
+                self._V_inv = np.linalg.inv(V)
+                strategy = 'eig'
+            elif strategy == 'eig':
+                raise ValueError('F is not diagonalizable with a well-conditioned eigenbasis')
+            else:
+                strategy = 'squaring'
+
+        if strategy not in ('dense', 'eig', 'squaring', 'matvec'):
+            raise ValueError('Unknown strategy: ' + str(strategy))
+
+        self.strategy = strategy
+        self._squares = [self.F]
+
+        if strategy == 'dense':
+            self._dense = [np.linalg.matrix_power(self.F, k) for k in range(size)]
+
+    def __len__(self):
+
+        return self.size
+
+    def _power(self, k):
+
+        if self.strategy == 'dense':
+            return self._dense[k]
+
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            return self._cache[k]
+
+        if self.strategy == 'eig':
+            power = np.matmul(self._V * self._e ** k, self._V_inv)
+            power = power.real if np.isrealobj(self.F) else power
+        else:
+            power = np.eye(np.shape(self.F)[0])
+            j = 0
+            while k >> j:
+                if len(self._squares) <= j:
+                    self._squares.append(np.matmul(self._squares[-1], self._squares[-1]))
+                if (k >> j) & 1:
+                    power = np.matmul(power, self._squares[j])
+                j += 1
+
+        power.setflags(write=False)
+        self._cache[k] = power
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return power
+
+    def __getitem__(self, k):
+
+        if k < 0 or k >= self.size:
+            raise IndexError('power index out of range')
+
+        return self._power(k)
+
+    def rmatvec(self, k, v):
+
+        # (F^k)^T v for v with leading batch axes, i.e. v @ F^k in row form
+
+        if self.strategy == 'eig':
+            product = np.matmul(np.matmul(v, self._V) * self._e ** k, self._V_inv)
+            return product.real if np.isrealobj(self.F) and np.isrealobj(v) else product
+
+        if self.strategy == 'matvec' and k not in self._cache:
+            for _ in range(k):
+                v = np.matmul(v, self.F)
+            return v
+
+        return np.matmul(v, self._power(k))
+
+    def norm(self, k):
+
+        if k < np.shape(self._norms)[0]:
+            return self._norms[k]
+
+        return np.linalg.norm(self[k], 2)
+
+    def norms(self, T=None):
+
+        # ||F^k||_2 for k < T (default: size), computed once
+
+        T = self.size if T is None else T
+
+        if np.shape(self._norms)[0] < T:
+            self._norms = _get_power_norms(self.F, T)
+            self._norms.setflags(write=False)
+
+        return self._norms[:T]
+
+    def arrays(self):
+
+        # The arrays held, e.g. to place them in shared memory (see bundle.py); dense
+        # powers are stacked into one (size, n, n) array
+
+        arrays = dict(F=self.F, norms=self._norms)
+
+        if self.strategy == 'eig':
+            arrays.update(e=self._e, V=self._V, V_inv=self._V_inv)
+        if self.strategy == 'dense':
+            arrays['dense'] = np.array(self._dense)
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, size, strategy, cache_size=64):
+
+        # FPowers around the arrays of arrays(), used as they are without copying
+
+        powers = cls.__new__(cls)
+        powers.F = arrays['F']
+        powers.size = size
+        powers.strategy = strategy
+        powers.cache_size = cache_size
+        powers._cache = collections.OrderedDict()
+        powers._norms = arrays['norms']
+        powers._squares = [powers.F]
+
+        if strategy == 'eig':
+            powers._e, powers._V, powers._V_inv = arrays['e'], arrays['V'], arrays['V_inv']
+        if strategy == 'dense':
+            powers._dense = arrays['dense']
+
+        return powers
+
+
+# Feedforward terms
+
+def _get_G(P, F, w, lookahead=None, powers=None):
+
+    # G_t = sum_{s >= t} (F^T)^{s - t} P w_s, computed backwards through
+    # G_t = P w_t + F^T G_{t+1}; w may carry leading batch axes, time is axis -2.
+    # With a lookahead k only w_t, ..., w_{t+k-1} enter, using
+    # G^k_t = G_t - (F^T)^k G_{t+k} with (F^T)^k applied through powers, the powers of F
+
+    with PROFILER.phase('feedforward'):
+
+        G = np.matmul(w, np.transpose(P))
+
+        for t in range(np.shape(w)[-2] - 2, -1, -1):
+            G[..., t, :] += np.matmul(G[..., t + 1, :], F)
+
+        if lookahead is not None and lookahead < np.shape(w)[-2]:
+            G[..., :np.shape(w)[-2] - lookahead, :] -= _power_product(powers, lookahead, G[..., lookahead:, :])
+
+    return G
+
+
+# Costs
+
+def _get_cost(x, u, Q, R, P, y=None, v=None):
+
+    # sum_{t < T-1} x_t^T Q y_t + u_t^T R v_t + x_{T-1}^T P y_{T-1} over trajectories
+    # x, y of shape (..., T, n) and u, v of shape (..., T, m); y, v default to x, u
+
+    y = x if y is None else y
+    v = u if v is None else v
+
+    with PROFILER.phase('cost'):
+        cost = (np.einsum('...ti,ij,...tj->...', x[..., :-1, :], Q, y[..., :-1, :])
+                + np.einsum('...ti,ij,...tj->...', u[..., :-1, :], R, v[..., :-1, :])
+                + np.einsum('...i,ij,...j->...', x[..., -1, :], P, y[..., -1, :]))
+
+    return cost[()]
+
+
+# Norm statistics
+
+_NORM_CACHE = collections.OrderedDict()
+_NORM_CACHE_SIZE = 16
+_FFT_MIN_LENGTH = 512
+
+
+def _get_norm_table(T, P, F):
+
+    # ||F^k||_2 ||P||_2 for k < T, which only depends on the lag k; P and F may
+    # be the diagonals of a diagonal system
+
+    if np.ndim(P) == 1:
+        return np.max(np.abs(F)) ** np.arange(T) * np.max(np.abs(P))
+
+    key = (T, np.shape(P), P.tobytes(), np.asarray(F[1]).tobytes())
+
+    if key in _NORM_CACHE:
+        _NORM_CACHE.move_to_end(key)
+        return _NORM_CACHE[key]
+
+    norms = F.norms(T) if isinstance(F, FPowers) else _get_power_norms(F[1], T)
+    table = norms * np.linalg.norm(P, 2)
+    table.setflags(write=False)
+
+    _NORM_CACHE[key] = table
+    if len(_NORM_CACHE) > _NORM_CACHE_SIZE:
+        _NORM_CACHE.popitem(last=False)
+
+    return table
+
+
+def _suffix_correlation(table, a):
+
+    # inner[..., t] = sum_{s >= t} table[s - t] * a[..., s]; direct for short
+    # horizons, zero-padded FFT otherwise
+
+    T = np.shape(a)[-1]
+
+    if T < _FFT_MIN_LENGTH:
+        lag = np.arange(T)[np.newaxis, :] - np.arange(T)[:, np.newaxis]
+        kernel = np.where(lag >= 0, table[np.clip(lag, 0, T - 1)], 0)
+        return np.matmul(a, np.transpose(kernel))
+
+    L = 1 << (2 * T - 1).bit_length()
+    inner = np.fft.irfft(np.fft.rfft(a[..., ::-1], L) * np.fft.rfft(table, L), L)[..., :T][..., ::-1]
+
+    return np.maximum(inner, 0)
+
+
+def _get_norms(T, noise, w, estimated_w, P, F):
+
+    # epsilon, X, Y, W and Z of the competitive-ratio bound; noise and
+    # estimated_w may carry a leading Monte Carlo axis
+
+    with PROFILER.phase('norms'):
+
+        table = _get_norm_table(T, P, F)
+
+        inner_epsilon = _suffix_correlation(table, np.linalg.norm(noise, axis=-1))
+        inner_W = _suffix_correlation(table, np.linalg.norm(estimated_w, axis=-1))
+        inner_Z = _suffix_correlation(table, np.linalg.norm(w, axis=-1))
+
+        epsilon = np.sum(inner_epsilon ** 2, axis=-1)
+        W = np.sum(inner_W ** 2, axis=-1)
+        Z = np.sum(inner_Z ** 2, axis=-1) * np.ones(np.shape(epsilon))
+        Y = np.sum(inner_epsilon * inner_Z, axis=-1)
+        X = np.sum(inner_Z * inner_W, axis=-1)
+
+    return epsilon, X, Y, W, Z
+
+
+# Truncated lookahead
+
+def _power_product(F, k, v):
+
+    # v @ F^k; FPowers go through rmatvec, which never forms F^k under 'matvec'
+
+    if isinstance(F, FPowers):
+        return F.rmatvec(k, v)
+
+    return np.matmul(v, F[k])
+
+
+def truncation_bound(T, P, F, estimated_w, lookahead):
+
+    # max_t ||G_t - G^k_t|| <= max_t sum_{k' >= k} ||F^{k'}|| ||P|| ||estimated_w_{t+k'}||;
+    # one value per trajectory
+
+    if lookahead is None or lookahead >= T:
+        return np.zeros(np.shape(estimated_w)[:-2])[()]
+
+    table = np.array(_get_norm_table(T, P, F))
+    table[:lookahead] = 0
+
+    return np.max(_suffix_correlation(table, np.linalg.norm(estimated_w, axis=-1)), axis=-1)
+
+
+def choose_lookahead(T, P, F, estimated_w, tol):
+
+    # Smallest k whose tail sum_{k' >= k} ||F^{k'}|| ||P|| max_s ||estimated_w_s|| is at most tol
+
+    tail = np.append(np.cumsum(_get_norm_table(T, P, F)[::-1])[::-1], 0) * np.max(
+        np.linalg.norm(estimated_w, axis=-1))
+
+    return int(np.argmax(tail <= tol))
+
+
+def resolve_lookahead(T, P, F, estimated_w, lookahead=None, tol=None):
+
+    # A tolerance takes precedence over a fixed lookahead; None keeps the whole horizon
+
+    if tol is not None:
+        return choose_lookahead(T, P, F, estimated_w, tol)
+
+    return lookahead
+
+
+def compute_upper_bounds(A, B, Q, R, OPT, lam, epsilon, X, Y, W, Z):
+
+    # bound_1, bound_2 and their minimum over a whole grid: OPT, lam, epsilon, X, Y, W
+    # and Z broadcast against each other, and ||H|| comes from the cached gains (the
+    # diagonals for a diagonal system) instead of a factorization per cell
+
+    if np.ndim(A) == 1:
+        norm_H = np.max(np.abs(get_diagonal_gains(A, B, Q, R).H))
+    else:
+        norm_H = get_gains(A, B, Q, R).norm_H
+
+    OPT, lam, epsilon, X, Y, W, Z = (np.asarray(value, dtype=float) for value in (OPT, lam, epsilon, X, Y, W, Z))
+
+    bound_1 = 1 + norm_H * (
+            (lam ** 2) * (epsilon) / OPT + Z * ((1 - lam) ** 2) / OPT + Y * (1 - lam) * lam / OPT)
+    bound_2 = 1 + norm_H * (Z / OPT + (lam ** 2) * W / (OPT) + X * (1 - lam) * lam / OPT)
+
+    return bound_1, bound_2, np.minimum(bound_1, bound_2)
+
+
+def compute_upper_bound(A, B, Q, R, OPT, lam, epsilon, X, Y, W, Z):
+
+    return compute_upper_bounds(A, B, Q, R, OPT, lam, epsilon, X, Y, W, Z)[2][()]
+
+
+# Noise models: draw(rng, mu, sigma, shape) returns a whole block of prediction
+# errors in one call; rng is a np.random.Generator or the np.random module
+
+def _gaussian_noise(rng, mu, sigma, shape):
+
+    return rng.normal(mu, 0.005, shape)
+
+
+def _binomial_noise(rng, mu, sigma, shape):
+
+    return sigma * rng.binomial(10, 0.5, shape)
+
+
+def _laplace_noise(rng, mu, sigma, shape):
+
+    return rng.laplace(mu, sigma, shape)
+
+
+def _student_noise(rng, mu, sigma, shape):
+
+    # Heavy tails: Student's t with 3 degrees of freedom
+
+    return mu + sigma * rng.standard_t(3, shape)
+
+
+NOISE_MODELS = dict(Gaussian=_gaussian_noise, Binomial=_binomial_noise, Laplace=_laplace_noise,
+                    StudentT=_student_noise)
+
+
+def register_noise(name, draw):
+
+    NOISE_MODELS[name] = draw
+
+
+def generate_noise(mu, sigma, T, A, type, rng=None, M=None):
+
+    # (T, n) prediction errors, or (M, T, n) for M realizations, drawn in one call.
+    # Values come out in the order of drawing them row by row, so a block continues the
+    # stream of rng exactly as consecutive smaller calls would. rng is an optional
+    # np.random.Generator; the global np.random state is used otherwise
+
+    if type not in NOISE_MODELS:
+        raise ValueError('Noise type ' + str(type) + ' is not supported; choose from ' + ', '.join(NOISE_MODELS))
+
+    if rng is None:
+        rng = np.random
+
+    shape = (T, np.shape(A)[0]) if M is None else (M, T, np.shape(A)[0])
+
+    with PROFILER.phase('perturbation'):
+        noise = np.asarray(NOISE_MODELS[type](rng, mu, sigma, shape), dtype=float)
 
     return noise
 
 
-def generate_w(mode, A, T):
+# Perturbations are deterministic in (mode, A, T), so each process builds a
+# trajectory once and serves it read-only from a small LRU cache
+
+_W_CACHE = collections.OrderedDict()
+_W_CACHE_SIZE = 16
+
 
-    w = np.zeros((T, np.shape(A)[0]))
+def generate_w_range(mode, A, start, stop):
+
+    # Perturbations of slots start, ..., stop - 1
+
+    w = np.zeros((stop - start, np.shape(A)[0]))
 
     if mode == 'Tracking':
 
-        for t in range(T):
-            y_1, y_2 = tracking_coordinates(t)
-            y_3, y_4 = tracking_coordinates(t + 1)
+        # Ground-true predictions
+        y = np.zeros((stop - start + 1, np.shape(A)[0]))
+        y[:, 0], y[:, 1] = tracking_coordinates(np.arange(start, stop + 1))
+        w = np.matmul(y[:-1], np.transpose(A)) - y[1:]
 
-            # Ground-true predictions
-            w[t] = np.matmul(A, np.array([y_1, y_2, 0, 0])) - np.array([y_3, y_4, 0, 0])
+    if mode == 'EV' or mode == 'Extreme':
 
-    if mode == 'EV':
+        # arrival every 5 steps
+        w[np.arange(start, stop) % 5 != 0] = 5
 
-        # energy = np.load('data/energy.npy')
+    return w
 
-        for t in range(T):
-            # p = 0.5
-            for i in range(np.shape(A)[0]):
-                # coin = np.random.binomial(1, p, 1) # arriving rate 0.1
-                # if coin > 0:
-                if t % 5:
-                        # arrival every 5 steps
-                        # w[t][i] = random.choice(energy)
-                        w[t][i] = 5
-                else:
-                    w[t][i] = 0
-
-    if mode == 'Extreme':
 
-        for t in range(T):
-            # p = 0.5
-            for i in range(np.shape(A)[0]):
-                # coin = np.random.binomial(1, p, 1) # arriving rate 0.1
-                # if coin > 0:
-                if t % 5:
-                        # arrival every 5 steps
-                        # w[t][i] = random.choice(energy)
-                        w[t][i] = 5
-                else:
-                    w[t][i] = 0
+def _generate_w(mode, A, T):
+
+    return generate_w_range(mode, A, 0, T)
+
+
+def _w_key(mode, A, T):
+
+    A = np.asarray(A)
+
+    return mode, np.shape(A)[0], T, np.shape(A), A.dtype.str, A.tobytes()
+
+
+def prime_w(mode, A, T, w):
+
+    # Installs a precomputed trajectory, e.g. a read-only view of shared memory, as the
+    # result of generate_w(mode, A, T)
+
+    _W_CACHE[_w_key(mode, A, T)] = w
+    if len(_W_CACHE) > _W_CACHE_SIZE:
+        _W_CACHE.popitem(last=False)
+
+
+def generate_w(mode, A, T):
+
+    key = _w_key(mode, A, T)
+
+    if key in _W_CACHE:
+        _W_CACHE.move_to_end(key)
+        return _W_CACHE[key]
+
+    with PROFILER.phase('perturbation'):
+        w = _generate_w(mode, A, T)
+    w.setflags(write=False)
+
+    _W_CACHE[key] = w
+    if len(_W_CACHE) > _W_CACHE_SIZE:
+        _W_CACHE.popitem(last=False)
+
     return w
 
 
 # Determining lambda
 
+class FTLLambda:
+
+    # Follow-the-leader trust parameter, updated in O(n^2) per step.
+    #
+    # With m[s, t] = P x_s + sum_{l = s + 1}^{t} (F^T)^{l - s} weight x_l for x = w and
+    # x = estimated_w, the estimate after step t is
+    #     sum_{s < t} m_w[s, t]^T H m_est_w[s, t] / sum_{s < t} m_est_w[s, t]^T H m_est_w[s, t].
+    # Expanding m[s, t] = m[s, t - 1] + (F^T)^{t - s} weight x_t, both sums only need the
+    # vectors V = sum_{s < t} F^{t - s} H m[s, t - 1] and Gamma_t = sum_{k=1}^{t} F^k H (F^k)^T.
+    # weight = I reproduces _find_all_lam, weight = P the statistics of _find_lam; inputs
+    # may carry leading batch axes.
+
+    def __init__(self, P, F, H, ini_lambda, weight=None, clip=False):
+
+        self.P = P
+        self.F = F
+        self.H = H
+        self.ini_lambda = ini_lambda
+        self.weight = np.eye(np.shape(P)[0]) if weight is None else weight
+        self.clip = clip
+
+        self.t = 0
+        self._gamma = np.zeros(np.shape(P))
+        self._V_w = 0
+        self._V_est_w = 0
+        self._prediction_prediction = 0
+        self._prediction_perturbation = 0
+        self._diagonal_prediction = 0
+        self._diagonal_perturbation = 0
+
+    def _ratio(self, prediction_perturbation, prediction_prediction):
+
+        nonzero = prediction_prediction != 0
+        lam_optimal = np.where(nonzero, prediction_perturbation / np.where(nonzero, prediction_prediction, 1),
+                               self.ini_lambda)
+
+        if self.clip:
+            lam_optimal = np.where((lam_optimal < 0) | (lam_optimal > 1), np.abs(lam_optimal), lam_optimal)
+
+        return lam_optimal[()]
+
+    def _apply(self, x, M):
+
+        # M x for x with leading batch axes
+
+        return np.matmul(x, np.transpose(M))
+
+    def _propagate(self, gamma):
+
+        # F (gamma + H) F^T
+
+        return np.matmul(self.F, np.matmul(gamma + self.H, np.transpose(self.F)))
+
+    def update(self, w_t, estimated_w_t):
+
+        a = self._apply(estimated_w_t, self.weight)
+        b = self._apply(w_t, self.weight)
+        gamma_a = self._apply(a, self._gamma)
+
+        self._prediction_prediction = (self._prediction_prediction + self._diagonal_prediction
+                                       + 2 * np.sum(self._V_est_w * a, axis=-1) + np.sum(a * gamma_a, axis=-1))
+        self._prediction_perturbation = (self._prediction_perturbation + self._diagonal_perturbation
+                                         + np.sum(self._V_w * a, axis=-1) + np.sum(b * self._V_est_w, axis=-1)
+                                         + np.sum(b * gamma_a, axis=-1))
+
+        # Diagonal terms m[t, t] enter the sums from step t + 1 on
+
+        m_w = self._apply(w_t, self.P)
+        m_est_w = self._apply(estimated_w_t, self.P)
+        H_m_est_w = self._apply(m_est_w, self.H)
+        self._diagonal_prediction = np.sum(m_est_w * H_m_est_w, axis=-1)
+        self._diagonal_perturbation = np.sum(m_w * H_m_est_w, axis=-1)
+
+        self._V_est_w = self._apply(self._V_est_w + gamma_a + H_m_est_w, self.F)
+        self._V_w = self._apply(self._V_w + self._apply(b, self._gamma) + self._apply(m_w, self.H), self.F)
+        self._gamma = self._propagate(self._gamma)
+        self.t += 1
+
+        return self.lam()
+
+    def lam(self):
+
+        # Estimate over s < t, as emitted by update at step t
+
+        return self._ratio(self._prediction_perturbation, self._prediction_prediction)
+
+    def inclusive_lam(self):
+
+        # Estimate over s <= t, i.e. the lambda _find_lam uses at step t + 1
+
+        return self._ratio(self._prediction_perturbation + self._diagonal_perturbation,
+                           self._prediction_prediction + self._diagonal_prediction)
+
+
 def _find_lam(t, w, estimated_w, P, F, H, ini_lambda):
 
-    prediction_perturbation = 0
-    prediction_prediction = 0
+    estimator = FTLLambda(P, F[1], H, ini_lambda, weight=P)
 
     for s in range(t):
-        left_1 = 0
-        left_2 = 0
-        right = 0
-        for l in range(s, t):
-            left_1 += np.matmul(np.matmul(np.transpose(estimated_w[l]), np.transpose(P)), F[l - s])
-            left_2 += np.matmul(np.matmul(np.transpose(w[l]), np.transpose(P)), F[l - s])
-            right += np.transpose(np.matmul(np.matmul(np.transpose(estimated_w[l]), np.transpose(P)), F[l - s]))
-        prediction_prediction += np.matmul(left_1, np.matmul(H, right))
-        prediction_perturbation += np.matmul(left_2, np.matmul(H, right))
-
-    if prediction_prediction != 0:
-        lam_optimal = prediction_perturbation / prediction_prediction
-    else:
-        lam_optimal = ini_lambda
+        estimator.update(w[s], estimated_w[s])
+
+    if t == 0:
+        return ini_lambda
 
-    return lam_optimal
+    return estimator.inclusive_lam()
 
 
 def _find_all_lam(T, w, estimated_w, P, F, H, size, ini_lambda):
 
-    all_lam_optimal = []
-    matrix_w = np.zeros((T, T, size))
-    matrix_est_w = np.zeros((T, T, size))
-    for t in range(T):
-        prediction_prediction = 0
-        prediction_perturbation = 0
-        matrix_w[t, t] = np.matmul(P, w[t])
-        matrix_est_w[t, t] = np.matmul(P, estimated_w[t])
-        for s in range(t):
-            matrix_w[s, t] = matrix_w[s, t-1] + np.matmul(np.transpose(F[t-s]), w[t])
-            matrix_est_w[s, t] = matrix_est_w[s, t-1] + np.matmul(np.transpose(F[t-s]), estimated_w[t])
-            prediction_prediction += np.matmul(np.transpose(matrix_est_w[s, t]), np.matmul(H, matrix_est_w[s, t]))
-            prediction_perturbation += np.matmul(np.transpose(matrix_w[s, t]), np.matmul(H, matrix_est_w[s, t]))
-        if prediction_prediction != 0:
-            lam_optimal = prediction_perturbation / prediction_prediction
-        else:
-            lam_optimal = ini_lambda
-        all_lam_optimal.append(lam_optimal)
-    return all_lam_optimal
+    estimator = FTLLambda(P, F[1], H, ini_lambda)
+
+    with PROFILER.phase('lambda'):
+        return [estimator.update(w[t], estimated_w[t]) for t in range(T)]
 
 
 def run_robot(T, A, B, Q, R, noise, lam, mode, ini_lambda):
@@ -179,263 +994,484 @@ def run_robot(T, A, B, Q, R, noise, lam, mode, ini_lambda):
     _myopic_x = np.zeros((T, np.shape(A)[0]))
     _optimal_x = np.zeros((T, np.shape(A)[0]))
     _online_x = np.zeros((T, np.shape(A)[0]))
-    w = np.zeros((T, np.shape(A)[0]))
-    estimated_w = np.zeros((T, np.shape(A)[0]))
-    W = 0
-    Z = 0
-    Y = 0
-    X = 0
-    epsilon = 0
+    _myopic_u = np.zeros((T, np.shape(B)[1]))
+    _online_u = np.zeros((T, np.shape(B)[1]))
+    _optimal_u = np.zeros((T, np.shape(B)[1]))
 
-    P, _, _ = control.dare(A, B, Q, R)
-    D = _get_D(B, P, R)
-    H = _get_H(B, D)
-    F = _get_F(A, P, H)
+    P, D, H, F = get_gains(A, B, Q, R)[:4]
+    F_list = FPowers(F, T + 1)
 
-    myopic_ALG = 0
-    online_ALG = 0
-    OPT = 0
+    # Generate perturbations
 
-    for t in range(T):
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
 
-        # Generate perturbations
+    # Compute norms
 
-        w = generate_w(mode, A, T)
-        estimated_w = w + noise
+    epsilon, X, Y, W, Z = _get_norms(T, noise, w, estimated_w, P, F_list)
 
-        # Compute norms
+    _all_myopic_G = _get_G(P, F, estimated_w)
+    _all_optimal_G = _get_G(P, F, w)
+    _FTL_estimator = FTLLambda(P, F, H, ini_lambda, weight=P)
 
-        inner_epsilon = 0
-        inner_W = 0
-        inner_Z = 0
-        for s in range(t, T):
-            inner_epsilon += np.linalg.norm(matrix_power(F, s - t), 2) * np.linalg.norm(P, 2) * np.linalg.norm(noise[s])
-            inner_W += np.linalg.norm(matrix_power(F, s - t), 2) * np.linalg.norm(P, 2) * np.linalg.norm(estimated_w[s])
-            inner_Z += np.linalg.norm(matrix_power(F, s - t), 2) * np.linalg.norm(P, 2) * np.linalg.norm(w[s])
-        epsilon += inner_epsilon ** 2
-        W += inner_W ** 2
-        Z += inner_Z ** 2
-        Y += inner_epsilon * inner_Z
-        X += inner_Z * inner_W
+    with PROFILER.phase('rollout'):
 
-    for t in range(T):
+        for t in range(T):
 
-        # Update actions
+            # Update actions
 
-        _myopic_E = np.matmul(P, np.matmul(A, _myopic_x[t]))
-        _online_E = np.matmul(P, np.matmul(A, _online_x[t]))
-        _optimal_E = np.matmul(P, np.matmul(A, _optimal_x[t]))
-        _myopic_G = 0
-        _optimal_G = 0
+            _myopic_E = np.matmul(P, np.matmul(A, _myopic_x[t]))
+            _online_E = np.matmul(P, np.matmul(A, _online_x[t]))
+            _optimal_E = np.matmul(P, np.matmul(A, _optimal_x[t]))
+            _myopic_G = _all_myopic_G[t]
+            _optimal_G = _all_optimal_G[t]
 
-        for s in range(t, T):
-            _myopic_G += np.matmul(np.linalg.matrix_power(np.transpose(F), s - t), np.matmul(P, estimated_w[s]))
-            _optimal_G += np.matmul(np.linalg.matrix_power(np.transpose(F), s - t), np.matmul(P, w[s]))
+            # Myopic algorithm
 
-        # Myopic algorithm
+            _myopic_u[t] = -np.matmul(D, _myopic_E) - lam * np.matmul(D, _myopic_G)
 
-        _myopic_u = -np.matmul(D, _myopic_E) - lam * np.matmul(D, _myopic_G)
+            # Online algorithm (time-varying lambda)
 
-        # Online algorithm (time-varying lambda)
+            _FTL_lam = _FTL_estimator.inclusive_lam() if t > 0 else ini_lambda
+            _FTL_estimator.update(w[t], estimated_w[t])
+            _online_u[t] = -np.matmul(D, _online_E) - _FTL_lam * np.matmul(D, _myopic_G)
 
-        _FTL_lam = _find_lam(t, w, estimated_w, P, F, H, ini_lambda)
-        _online_u = -np.matmul(D, _online_E) - _FTL_lam * np.matmul(D, _myopic_G)
+            # Omniscient algorithm
 
-        # Omniscient algorithm
+            _optimal_u[t] = -np.matmul(D, _optimal_E) - np.matmul(D, _optimal_G)
 
-        _optimal_u = -np.matmul(D, _optimal_E) - np.matmul(D, _optimal_G)
+            # Update states
 
-        # Update states
+            if t < T - 1:
+                _myopic_x[t + 1] = np.matmul(A, _myopic_x[t]) + np.matmul(B, _myopic_u[t]) + w[t]
+                _online_x[t + 1] = np.matmul(A, _online_x[t]) + np.matmul(B, _online_u[t]) + w[t]
+                _optimal_x[t + 1] = np.matmul(A, _optimal_x[t]) + np.matmul(B, _optimal_u[t]) + w[t]
 
-        if t < T - 1:
-            _myopic_x[t + 1] = np.matmul(A, _myopic_x[t]) + np.matmul(B, _myopic_u) + w[t]
-            _online_x[t + 1] = np.matmul(A, _online_x[t]) + np.matmul(B, _online_u) + w[t]
-            _optimal_x[t + 1] = np.matmul(A, _optimal_x[t]) + np.matmul(B, _optimal_u) + w[t]
+    # Compute costs
 
-        # Update costs
+    myopic_ALG = _get_cost(_myopic_x, _myopic_u, Q, R, P)
+    online_ALG = _get_cost(_online_x, _online_u, Q, R, P)
+    OPT = _get_cost(_optimal_x, _optimal_u, Q, R, P)
 
-        if t < T - 1:
+    PROFILER.count('rollouts', 3)
+    logger.debug('Online cost %s, myopic cost %s, optimal cost %s', online_ALG, myopic_ALG, OPT)
+    return epsilon, X, Y, W, Z, myopic_ALG, online_ALG, OPT
 
-            myopic_ALG += np.matmul(np.transpose(_myopic_x[t]), np.matmul(Q, _myopic_x[t])) + np.matmul(
-                np.transpose(_myopic_u), np.matmul(R, _myopic_u))
-            online_ALG += np.matmul(np.transpose(_online_x[t]), np.matmul(Q, _online_x[t])) + np.matmul(
-                np.transpose(_online_u), np.matmul(R, _online_u))
-            OPT += np.matmul(np.transpose(_optimal_x[t]), np.matmul(Q, _optimal_x[t])) + np.matmul(
-                np.transpose(_optimal_u), np.matmul(R, _optimal_u))
 
-        else:
-            online_ALG += np.matmul(np.transpose(_online_x[t]), np.matmul(P, _online_x[t]))
-            myopic_ALG += np.matmul(np.transpose(_myopic_x[t]), np.matmul(P, _myopic_x[t]))
-            OPT += np.matmul(np.transpose(_optimal_x[t]), np.matmul(P, _optimal_x[t]))
+def run_lqr_robot(T, A, B, Q, R, noise, lam, mode, P, D, H, F, lookahead=None):
 
+    if np.ndim(P) == 1:
+        return run_diagonal_lqr_robot(T, A, B, Q, R, noise, lam, mode, P, D, H, F, lookahead)
 
-    print("Online Cost is")
-    print(online_ALG)
-    print("Myopic Cost is")
-    print(myopic_ALG)
-    print("Optimal Cost is")
-    print(OPT)
-    return epsilon, X, Y, W, Z, myopic_ALG, online_ALG, OPT
+    # Initialize
 
+    _myopic_x = np.zeros((T, np.shape(A)[0]))
+    _myopic_u = np.zeros((T, np.shape(B)[1]))
 
-def run_lqr_robot(T, A, B, Q, R, noise, lam, mode, P, D, H, F):
+    # Generate perturbations
 
-    # Initialize
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
 
-    _myopic_x = np.zeros((T, np.shape(A)[0]))
-    w = np.zeros((T, np.shape(A)[0]))
-    estimated_w = np.zeros((T, np.shape(A)[0]))
-    for t in range(T):
+    _all_myopic_G = _get_G(P, F[1], estimated_w, lookahead, F)
 
-        # Generate perturbations
+    with PROFILER.phase('rollout'):
 
-        w = generate_w(mode, A, T)
-        estimated_w = w + noise
+        for t in range(T):
 
-    myopic_ALG = 0
+            # Update actions
 
-    for t in range(T):
+            _myopic_E = np.matmul(P, np.matmul(A, _myopic_x[t]))
+            _myopic_G = _all_myopic_G[t]
 
-        # Update actions
+            # Myopic algorithm
 
-        _myopic_E = np.matmul(P, np.matmul(A, _myopic_x[t]))
-        _myopic_G = 0
+            _myopic_u[t] = -np.matmul(D, _myopic_E) - lam * np.matmul(D, _myopic_G)
 
-        for s in range(t, T):
-            _myopic_G += np.matmul(np.transpose(F[s - t]), np.matmul(P, estimated_w[s]))
+            # Update states
 
-        # Myopic algorithm
+            if t < T - 1:
+                _myopic_x[t + 1] = np.matmul(A, _myopic_x[t]) + np.matmul(B, _myopic_u[t]) + w[t]
 
-        _myopic_u = -np.matmul(D, _myopic_E) - lam * np.matmul(D, _myopic_G)
+    # Compute costs
 
-        # Update states
+    myopic_ALG = _get_cost(_myopic_x, _myopic_u, Q, R, P)
 
-        if t < T - 1:
-            _myopic_x[t + 1] = np.matmul(A, _myopic_x[t]) + np.matmul(B, _myopic_u) + w[t]
+    PROFILER.count('rollouts')
+    logger.debug('Myopic cost %s', myopic_ALG)
+    if lookahead is not None and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Truncation bound %s', truncation_bound(T, P, F, estimated_w, lookahead))
+    return myopic_ALG
 
-        # Update costs
 
-        if t < T - 1:
+def lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead=None):
 
-            myopic_ALG += np.matmul(np.transpose(_myopic_x[t]), np.matmul(Q, _myopic_x[t])) + np.matmul(
-                np.transpose(_myopic_u), np.matmul(R, _myopic_u))
-        else:
-            myopic_ALG += np.matmul(np.transpose(_myopic_x[t]), np.matmul(P, _myopic_x[t]))
+    # The lambda-confident state splits as x_t = x0_t + lam * x1_t, where x0 is
+    # driven by w under pure feedback and x1 by the feedforward -D G_t alone,
+    # so ALG(lam) = a + b * lam + c * lam ** 2 exactly
 
-    print("Myopic Cost is")
-    print(myopic_ALG)
-    return myopic_ALG
+    if np.ndim(P) == 1:
+        return diagonal_lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead)
+
+    _x0 = np.zeros((T, np.shape(A)[0]))
+    _x1 = np.zeros((T, np.shape(A)[0]))
+    _u0 = np.zeros((T, np.shape(B)[1]))
+    _u1 = np.zeros((T, np.shape(B)[1]))
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
+
+    _all_myopic_G = _get_G(P, F[1], estimated_w, lookahead, F)
+
+    with PROFILER.phase('rollout'):
+
+        for t in range(T):
+
+            # Update actions
+
+            _u0[t] = -np.matmul(D, np.matmul(P, np.matmul(A, _x0[t])))
+            _u1[t] = -np.matmul(D, np.matmul(P, np.matmul(A, _x1[t]))) - np.matmul(D, _all_myopic_G[t])
 
+            # Update states
 
-def run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, plot_curve):
+            if t < T - 1:
+                _x0[t + 1] = np.matmul(A, _x0[t]) + np.matmul(B, _u0[t]) + w[t]
+                _x1[t + 1] = np.matmul(A, _x1[t]) + np.matmul(B, _u1[t])
+
+    # Compute costs
+
+    PROFILER.count('rollouts')
+    return np.array([_get_cost(_x0, _u0, Q, R, P), 2 * _get_cost(_x0, _u0, Q, R, P, _x1, _u1),
+                     _get_cost(_x1, _u1, Q, R, P)])
+
+
+def evaluate_lqr_cost(coefficients, lam):
+
+    a, b, c = coefficients
+
+    return a + b * np.asarray(lam) + c * np.asarray(lam) ** 2
+
+
+def find_best_lam(coefficients, lower=None, upper=None):
+
+    # Minimizer of the (convex) quadratic ALG(lam), optionally restricted to [lower, upper]
+
+    a, b, c = coefficients
+
+    if c > 0:
+        lam_optimal = -b / (2 * c)
+    else:
+        lam_optimal = 0 if lower is None else lower
+
+    if lower is not None:
+        lam_optimal = max(lam_optimal, lower)
+    if upper is not None:
+        lam_optimal = min(lam_optimal, upper)
+
+    return lam_optimal, evaluate_lqr_cost(coefficients, lam_optimal)
+
+
+def run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, plot_curve, lookahead=None):
+
+    # Diagonal systems (vector P, see get_diagonal_gains) take the elementwise path
+
+    if np.ndim(P) == 1:
+        return run_diagonal_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead)
 
     # Initialize
 
     _myopic_x = np.zeros((T, np.shape(A)[0]))
     _optimal_x = np.zeros((T, np.shape(A)[0]))
     _online_x = np.zeros((T, np.shape(A)[0]))
-    w = np.zeros((T, np.shape(A)[0]))
-    estimated_w = np.zeros((T, np.shape(A)[0]))
-    W = 0
-    Z = 0
-    Y = 0
-    X = 0
-    epsilon = 0
-
-    online_ALG = 0
-    OPT = 0
-
-    for t in range(T):
-
-        # Generate perturbations
-
-        w = generate_w(mode, A, T)
-        estimated_w = w + noise
-
-        # Compute norms
-
-        inner_epsilon = 0
-        inner_W = 0
-        inner_Z = 0
-        for s in range(t, T):
-            inner_epsilon += np.linalg.norm(F[s - t], 2) * np.linalg.norm(P, 2) * np.linalg.norm(noise[s])
-            inner_W += np.linalg.norm(F[s - t], 2) * np.linalg.norm(P, 2) * np.linalg.norm(estimated_w[s])
-            inner_Z += np.linalg.norm(F[s - t], 2) * np.linalg.norm(P, 2) * np.linalg.norm(w[s])
-        epsilon += inner_epsilon ** 2
-        W += inner_W ** 2
-        Z += inner_Z ** 2
-        Y += inner_epsilon * inner_Z
-        X += inner_Z * inner_W
+    _online_u = np.zeros((T, np.shape(B)[1]))
+    _optimal_u = np.zeros((T, np.shape(B)[1]))
+
+    # Generate perturbations
+
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
+
+    # Compute norms
+
+    epsilon, X, Y, W, Z = _get_norms(T, noise, w, estimated_w, P, F)
 
     _FTL_all_lam = _find_all_lam(T, w, estimated_w, P, F, H, np.shape(A)[0], ini_lambda)
     # _FTL_all_lam = [0 for t in range(T)]
 
-    for t in range(T):
+    _all_myopic_G = _get_G(P, F[1], estimated_w, lookahead, F)
+    _all_optimal_G = _get_G(P, F[1], w)
 
-        # Update actions
+    with PROFILER.phase('rollout'):
 
-        _online_E = np.matmul(P, np.matmul(A, _online_x[t]))
-        _optimal_E = np.matmul(P, np.matmul(A, _optimal_x[t]))
-        _myopic_G = 0
-        _optimal_G = 0
+        for t in range(T):
 
-        for s in range(t, T):
-            _myopic_G += np.matmul(np.transpose(F[s - t]), np.matmul(P, estimated_w[s]))
-            _optimal_G += np.matmul(np.transpose(F[s - t]), np.matmul(P, w[s]))
+            # Update actions
 
-        # Online algorithm (time-varying lambda)
+            _online_E = np.matmul(P, np.matmul(A, _online_x[t]))
+            _optimal_E = np.matmul(P, np.matmul(A, _optimal_x[t]))
+            _myopic_G = _all_myopic_G[t]
+            _optimal_G = _all_optimal_G[t]
 
-        if _FTL_all_lam[t] < 0 or _FTL_all_lam[t] > 1:
-            _FTL_all_lam[t] = np.abs(_FTL_all_lam[t])
-        _online_u = -np.matmul(D, _online_E) - _FTL_all_lam[t] * np.matmul(D, _myopic_G)
+            # Online algorithm (time-varying lambda)
 
-        # Omniscient algorithm
+            if _FTL_all_lam[t] < 0 or _FTL_all_lam[t] > 1:
+                _FTL_all_lam[t] = np.abs(_FTL_all_lam[t])
+            _online_u[t] = -np.matmul(D, _online_E) - _FTL_all_lam[t] * np.matmul(D, _myopic_G)
 
-        _optimal_u = -np.matmul(D, _optimal_E) - np.matmul(D, _optimal_G)
+            # Omniscient algorithm
 
-        # Update states
+            _optimal_u[t] = -np.matmul(D, _optimal_E) - np.matmul(D, _optimal_G)
 
-        if t < T - 1:
-            _online_x[t + 1] = np.matmul(A, _online_x[t]) + np.matmul(B, _online_u) + w[t]
-            _optimal_x[t + 1] = np.matmul(A, _optimal_x[t]) + np.matmul(B, _optimal_u) + w[t]
+            # Update states
 
-        # Update costs
+            if t < T - 1:
+                _online_x[t + 1] = np.matmul(A, _online_x[t]) + np.matmul(B, _online_u[t]) + w[t]
+                _optimal_x[t + 1] = np.matmul(A, _optimal_x[t]) + np.matmul(B, _optimal_u[t]) + w[t]
 
-        if t < T - 1:
+    # Compute costs
 
-            online_ALG += np.matmul(np.transpose(_online_x[t]), np.matmul(Q, _online_x[t])) + np.matmul(
-                np.transpose(_online_u), np.matmul(R, _online_u))
-            OPT += np.matmul(np.transpose(_optimal_x[t]), np.matmul(Q, _optimal_x[t])) + np.matmul(
-                np.transpose(_optimal_u), np.matmul(R, _optimal_u))
-        else:
-            online_ALG += np.matmul(np.transpose(_online_x[t]), np.matmul(P, _online_x[t]))
-            OPT += np.matmul(np.transpose(_optimal_x[t]), np.matmul(P, _optimal_x[t]))
+    online_ALG = _get_cost(_online_x, _online_u, Q, R, P)
+    OPT = _get_cost(_optimal_x, _optimal_u, Q, R, P)
+    PROFILER.count('rollouts', 2)
+
+    # Plotting happens off the simulation path: a list plot_curve collects the
+    # trajectory and lambdas for plots.render_tracking, True renders them to files now
+
+    if isinstance(plot_curve, list):
+        plot_curve.append((_online_x, np.array(_FTL_all_lam)))
+    elif plot_curve is True:
+        from plots import render_tracking
+        render_tracking('tracking', _online_x, _FTL_all_lam)
+
+    logger.debug('Online cost %s, optimal cost %s', online_ALG, OPT)
+    if lookahead is not None and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Truncation bound %s', truncation_bound(T, P, F, estimated_w, lookahead))
+    return epsilon, X, Y, W, Z, online_ALG, OPT
+
+# Batched Monte Carlo (noise of shape (M, T, n), one state column per realization)
+
+def _find_all_batch_lam(T, w, estimated_w, P, F, H, ini_lambda):
 
+    # _find_all_lam for estimated_w of shape (M, T, n); returns an (M, T) array
 
-    if plot_curve is True:
+    estimator = FTLLambda(P, F[1], H, ini_lambda)
 
-        y = np.zeros((T, 2))
+    with PROFILER.phase('lambda'):
+        return np.stack([estimator.update(w[t], estimated_w[:, t]) for t in range(T)], axis=-1)
+
+
+def batch_lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead=None):
+
+    # Row m holds (a, b, c) of lqr_cost_coefficients for noise[m]
+
+    if np.ndim(P) == 1:
+        return diagonal_lqr_cost_coefficients(T, A, B, Q, R, noise, mode, P, D, H, F, lookahead)
+
+    M = np.shape(noise)[0]
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
+
+    _x0 = np.zeros((M, T, np.shape(A)[0]))
+    _x1 = np.zeros((M, T, np.shape(A)[0]))
+    _u0 = np.zeros((M, T, np.shape(B)[1]))
+    _u1 = np.zeros((M, T, np.shape(B)[1]))
+    _K = np.matmul(D, np.matmul(P, A))
+
+    _all_myopic_G = _get_G(P, F[1], estimated_w, lookahead, F)
+
+    with PROFILER.phase('rollout'):
 
         for t in range(T):
-            y_1, y_2 = tracking_coordinates(t)
-            y[t] = [y_1, y_2]
-
-        # plot_track(_myopic_x,y,r'$\lambda$=1','red')
-        plot_track(_online_x[:60],y[:60],r'$t\in [0,60]$','blue')
-        plot_track(_online_x[60:120],y[60:120],r'$t\in (60,90]$','green')
-        plot_track(_online_x[120:180],y[120:180],r'$t\in [90,150]$','magenta')
-        plot_track(_online_x[180:240],y[180:240],r'$t\in [150,210]$','gray')
-        # plot_track(_optimal_x,y,'Offline-Optimal','green')
-        plot_trajectory(y[0:240],'black')
-        plt.grid()
-        plt.show()
-
-        plt.figure()
-        plot_lambda(_FTL_all_lam)
-        plt.show()
-
-    print("Online Cost is")
-    print(online_ALG)
-    print("Optimal Cost is")
-    print(OPT)
-    return epsilon, X, Y, W, Z, online_ALG, OPT
\ No newline at end of file
+
+            # Update actions
+
+            _u0[:, t] = -np.matmul(_x0[:, t], np.transpose(_K))
+            _u1[:, t] = -np.matmul(_x1[:, t], np.transpose(_K)) - np.matmul(_all_myopic_G[:, t], np.transpose(D))
+
+            # Update states
+
+            if t < T - 1:
+                _x0[:, t + 1] = np.matmul(_x0[:, t], np.transpose(A)) + np.matmul(_u0[:, t], np.transpose(B)) + w[t]
+                _x1[:, t + 1] = np.matmul(_x1[:, t], np.transpose(A)) + np.matmul(_u1[:, t], np.transpose(B))
+
+    # Compute costs
+
+    PROFILER.count('rollouts', M)
+    return np.stack([_get_cost(_x0, _u0, Q, R, P), 2 * _get_cost(_x0, _u0, Q, R, P, _x1, _u1),
+                     _get_cost(_x1, _u1, Q, R, P)], axis=-1)
+
+
+def run_batch_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead=None):
+
+    # Batched run_fix_lqr_robot: returns arrays of length M for epsilon, X, Y, W, Z, online_ALG and OPT
+
+    if np.ndim(P) == 1:
+        return run_diagonal_fix_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead)
+
+    M = np.shape(noise)[0]
+    w = generate_w(mode, A, T)
+    estimated_w = w + noise
+
+    _online_x = np.zeros((M, T, np.shape(A)[0]))
+    _optimal_x = np.zeros((M, T, np.shape(A)[0]))
+    _online_u = np.zeros((M, T, np.shape(B)[1]))
+    _optimal_u = np.zeros((M, T, np.shape(B)[1]))
+    _K = np.matmul(D, np.matmul(P, A))
+
+    # Compute norms
+
+    epsilon, X, Y, W, Z = _get_norms(T, noise, w, estimated_w, P, F)
+
+    _FTL_all_lam = _find_all_batch_lam(T, w, estimated_w, P, F, H, ini_lambda)
+    _FTL_all_lam = np.where((_FTL_all_lam < 0) | (_FTL_all_lam > 1), np.abs(_FTL_all_lam), _FTL_all_lam)
+
+    _all_myopic_G = _get_G(P, F[1], estimated_w, lookahead, F)
+    _all_optimal_G = _get_G(P, F[1], w)
+
+    with PROFILER.phase('rollout'):
+
+        for t in range(T):
+
+            # Online algorithm (time-varying lambda)
+
+            _online_u[:, t] = (-np.matmul(_online_x[:, t], np.transpose(_K))
+                               - _FTL_all_lam[:, t, np.newaxis] * np.matmul(_all_myopic_G[:, t], np.transpose(D)))
+
+            # Omniscient algorithm
+
+            _optimal_u[:, t] = -np.matmul(_optimal_x[:, t], np.transpose(_K)) - np.matmul(_all_optimal_G[t],
+                                                                                          np.transpose(D))
+
+            # Update states
+
+            if t < T - 1:
+                _online_x[:, t + 1] = (np.matmul(_online_x[:, t], np.transpose(A))
+                                       + np.matmul(_online_u[:, t], np.transpose(B)) + w[t])
+                _optimal_x[:, t + 1] = (np.matmul(_optimal_x[:, t], np.transpose(A))
+                                        + np.matmul(_optimal_u[:, t], np.transpose(B)) + w[t])
+
+    # Compute costs
+
+    online_ALG = _get_cost(_online_x, _online_u, Q, R, P)
+    OPT = _get_cost(_optimal_x, _optimal_u, Q, R, P)
+    PROFILER.count('rollouts', 2 * M)
+
+    return epsilon, X, Y, W, Z, online_ALG, OPT
+
+
+# Diagonal systems (P, D, H and F given by their diagonals, see get_diagonal_gains).
+# Every product is elementwise, so a step costs O(n) instead of O(n^2); inputs may
+# carry leading Monte Carlo axes and costs are summed over the scalar systems
+
+class DiagonalFTLLambda(FTLLambda):
+
+    def __init__(self, P, F, H, ini_lambda, weight=None, clip=False):
+
+        FTLLambda.__init__(self, P, F, H, ini_lambda, np.ones(np.shape(P)) if weight is None else weight, clip)
+
+    def _apply(self, x, M):
+
+        return x * M
+
+    def _propagate(self, gamma):
+
+        return self.F * (gamma + self.H) * self.F
+
+
+def _get_diagonal_G(p, f, w, lookahead=None):
+
+    with PROFILER.phase('feedforward'):
+
+        G = w * p
+
+        for t in range(np.shape(w)[-2] - 2, -1, -1):
+            G[..., t, :] += f * G[..., t + 1, :]
+
+        if lookahead is not None and lookahead < np.shape(w)[-2]:
+            G[..., :np.shape(w)[-2] - lookahead, :] -= f ** lookahead * G[..., lookahead:, :]
+
+    return G
+
+
+def _get_diagonal_cost(x, u, q, r, p, y=None, v=None):
+
+    y = x if y is None else y
+    v = u if v is None else v
+
+    with PROFILER.phase('cost'):
+        cost = (np.einsum('...ti,i,...ti->...', x[..., :-1, :], q, y[..., :-1, :])
+                + np.einsum('...ti,i,...ti->...', u[..., :-1, :], r, v[..., :-1, :])
+                + np.einsum('...i,i,...i->...', x[..., -1, :], p, y[..., -1, :]))
+
+    return cost[()]
+
+
+def _diagonal_rollout(T, a, b, k, w, feedforward):
+
+    # x_{t+1} = a x_t + b u_t + w_t with u_t = -k x_t - feedforward_t, where w has shape
+    # (T, n) and feedforward may carry leading Monte Carlo axes; returns (x, u)
+
+    x = np.zeros(np.shape(feedforward))
+    u = np.zeros(np.shape(feedforward))
+
+    with PROFILER.phase('rollout'):
+
+        for t in range(T):
+            u[..., t, :] = -k * x[..., t, :] - feedforward[..., t, :]
+            if t < T - 1:
+                x[..., t + 1, :] = a * x[..., t, :] + b * u[..., t, :] + w[t]
+
+    PROFILER.count('rollouts', int(np.prod(np.shape(feedforward)[:-2])))
+
+    return x, u
+
+
+def run_diagonal_lqr_robot(T, a, b, q, r, noise, lam, mode, p, d, h, f, lookahead=None):
+
+    w = generate_w(mode, a, T)
+    estimated_w = w + noise
+
+    _myopic_x, _myopic_u = _diagonal_rollout(T, a, b, d * p * a, w, lam * d * _get_diagonal_G(p, f, estimated_w,
+                                                                                              lookahead))
+
+    return _get_diagonal_cost(_myopic_x, _myopic_u, q, r, p)
+
+
+def diagonal_lqr_cost_coefficients(T, a, b, q, r, noise, mode, p, d, h, f, lookahead=None):
+
+    # (a, b, c) of ALG(lam) along the last axis, as in lqr_cost_coefficients
+
+    w = generate_w(mode, a, T)
+    estimated_w = w + noise
+
+    _x0, _u0 = _diagonal_rollout(T, a, b, d * p * a, w, np.zeros(np.shape(noise)))
+    _x1, _u1 = _diagonal_rollout(T, a, b, d * p * a, np.zeros(np.shape(w)),
+                                 d * _get_diagonal_G(p, f, estimated_w, lookahead))
+
+    return np.stack([_get_diagonal_cost(_x0, _u0, q, r, p), 2 * _get_diagonal_cost(_x0, _u0, q, r, p, _x1, _u1),
+                     _get_diagonal_cost(_x1, _u1, q, r, p)], axis=-1)
+
+
+def run_diagonal_fix_lqr_robot(T, a, b, q, r, noise, mode, p, d, h, f, ini_lambda, lookahead=None):
+
+    w = generate_w(mode, a, T)
+    estimated_w = w + noise
+
+    # Compute norms
+
+    epsilon, X, Y, W, Z = _get_norms(T, noise, w, estimated_w, p, f)
+
+    estimator = DiagonalFTLLambda(p, f, h, ini_lambda)
+    with PROFILER.phase('lambda'):
+        _FTL_all_lam = np.stack([estimator.update(w[t], estimated_w[..., t, :]) for t in range(T)], axis=-1)
+    _FTL_all_lam = np.where((_FTL_all_lam < 0) | (_FTL_all_lam > 1), np.abs(_FTL_all_lam), _FTL_all_lam)
+
+    _online_x, _online_u = _diagonal_rollout(T, a, b, d * p * a, w, _FTL_all_lam[..., np.newaxis] * d
+                                             * _get_diagonal_G(p, f, estimated_w, lookahead))
+    _optimal_x, _optimal_u = _diagonal_rollout(T, a, b, d * p * a, w, np.ones(np.shape(noise)) * d
+                                               * _get_diagonal_G(p, f, w))
+
+    online_ALG = _get_diagonal_cost(_online_x, _online_u, q, r, p)
+    OPT = _get_diagonal_cost(_optimal_x, _optimal_u, q, r, p)
+
+    logger.debug('Online cost %s, optimal cost %s', online_ALG, OPT)
+    return epsilon, X, Y, W, Z, online_ALG, OPT
@@ -0,0 +1,97 @@
+from model import generate_noise
+import numpy as np
+import json
+import os
+
+
+def task_rng(seed, i, j):
+
+    # Each (sigma index, Monte Carlo index) cell draws from its own stream, so the
+    # noise does not depend on which worker runs the cell or in which order
+
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i, j)))
+
+
+# Noise bank
+#
+# Prediction errors of a whole sweep generated once: noise.npy (N, M, T, n) opened as
+# a memory map, plus manifest.json. Cell (i, j) holds the stream task_rng(seed, i, j)
+# the sweep workers draw, so replaying the bank changes no result. Every trust
+# parameter, policy and configuration replaying it sees the same errors (common
+# random numbers), and no noise is generated in the simulation loop.
+
+class NoiseBank:
+
+    def __init__(self, path, seed, noise, mu, sigma, T, A, M):
+
+        # seed may be None to reuse the seed of an existing bank
+
+        self.path = path
+        manifest_path = os.path.join(path, 'manifest.json')
+
+        existing = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                existing = json.load(f)
+            if seed is None:
+                seed = existing['seed']
+
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+
+        self.seed = seed
+        self.N = len(sigma)
+        self.M = M
+        manifest = dict(seed=seed, noise=noise, mu=mu, sigma=list(map(float, sigma)), T=T, n=np.shape(A)[0], M=M)
+
+        if existing is not None:
+            if existing != json.loads(json.dumps(manifest)):
+                raise ValueError('Noise bank ' + path + ' was generated for a different sweep')
+            self.noise = np.load(os.path.join(path, 'noise.npy'), mmap_mode='r')
+            return
+
+        os.makedirs(path, exist_ok=True)
+        bank = np.lib.format.open_memmap(os.path.join(path, 'noise.npy'), mode='w+', dtype=np.float64,
+                                         shape=(self.N, M, T, np.shape(A)[0]))
+        for i in range(self.N):
+            for j in range(M):
+                bank[i, j] = generate_noise(mu, sigma[i], T, A, noise, task_rng(seed, i, j))
+        bank.flush()
+        del bank
+
+        # The manifest goes last, so a bank only counts as generated once it is complete
+        temporary = manifest_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temporary, manifest_path)
+
+        self.noise = np.load(os.path.join(path, 'noise.npy'), mmap_mode='r')
+
+    @staticmethod
+    def load(path):
+
+        # Read-only (N, M, T, n) memory map of an existing bank, e.g. in a sweep worker
+
+        return np.load(os.path.join(path, 'noise.npy'), mmap_mode='r')
+
+    def get(self, i, j):
+
+        return self.noise[i, j]
+
+    def block(self, i):
+
+        # (M, T, n) errors of every Monte Carlo run at error level i
+
+        return self.noise[i]
+
+    def stream(self, i, j):
+
+        # noise(length) callable for streaming.stream_lqr_robot replaying cell (i, j)
+
+        start = [0]
+
+        def noise(length):
+            start[0] += length
+            return np.array(self.noise[i, j, start[0] - length:start[0]])
+
+        return noise
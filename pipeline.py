@@ -1,8 +1,18 @@
-from plots import *
 from model import *
 from _PARAMETERS import *
+from sweep import run_sweep
+from adaptive import adaptive_sweep
+from sequential import sequential_sweep
+from family import family_sweep
+from results import ResultStore
+from memo import *
+from streaming import run_stream_lqr_robot, StreamWriter
+from noise_bank import NoiseBank
+from instrument import PROFILER, Progress, logger
 import numpy as np
 import argparse
+import logging
+import os
 
 
 def get_configs():
@@ -13,7 +23,7 @@ def get_configs():
     parser.add_argument('--mode', default='Tracking', type=str,
                         help='Tracking or EV')
     parser.add_argument('--noise', default='Gaussian', type=str,
-                        help='Noise type, Gaussian or Binomial')
+                        help='Noise type: Gaussian, Binomial, Laplace or StudentT')
     parser.add_argument('--ini_lambda', default=0.3, type=float,
                         help='initial trust parameter lambda, in [0,1]')
     parser.add_argument('--save_output', default=False,
@@ -22,6 +32,8 @@ def get_configs():
                         type=bool, help='Plot output or not')
     parser.add_argument('--plot_curve', default=True,
                         type=bool, help='Plot tracking curve or not; only for mode = "Tracking" ')
+    parser.add_argument('--plot_dir', default='figures', type=str,
+                        help='Directory the figures are written to after the sweep')
     parser.add_argument('--J', default=6,
                         type=int, help='Number of trust parameters')
     parser.add_argument('--T', default=240,
@@ -30,6 +42,60 @@ def get_configs():
                         type=int, help='Number of error divisions')
     parser.add_argument('--M', default=5,
                         type=int, help='Number of Monte Carlo tests')
+    parser.add_argument('--batch', action='store_true',
+                        help='Simulate all Monte Carlo tests of an error level in one vectorized rollout')
+    parser.add_argument('--adaptive_tol', default=None, type=float,
+                        help='Refine the sigma grid until competitive ratios change by at most this fraction '
+                             'between neighbouring points, using at most N points; off if unset')
+    parser.add_argument('--adaptive_initial', default=5, type=int,
+                        help='Number of points of the initial sigma grid of the adaptive sweep')
+    parser.add_argument('--sequential_tol', default=None, type=float,
+                        help='Sample each error level until its confidence intervals are within this fraction '
+                             'of the competitive ratio, using at most N * M runs in all; off if unset')
+    parser.add_argument('--min_samples', default=3, type=int,
+                        help='Number of runs of every error level before the sequential sweep may stop it')
+    parser.add_argument('--confidence', default=0.95, type=float,
+                        help='Confidence level of the intervals of the sequential sweep')
+    parser.add_argument('--q_scales', default=None, type=float, nargs='+',
+                        help='Factors Q is scaled by in a sweep over a family of systems, one per pair with '
+                             '--r_scales; off if neither is set')
+    parser.add_argument('--r_scales', default=None, type=float, nargs='+',
+                        help='Factors R is scaled by in a sweep over a family of systems, one per pair with '
+                             '--q_scales; off if neither is set')
+    parser.add_argument('--lookahead', default=None,
+                        type=int, help='Number of predicted slots used by the feedforward; whole horizon if unset')
+    parser.add_argument('--lookahead_tol', default=None,
+                        type=float, help='Choose the lookahead per run from this bound on the truncated feedforward')
+    parser.add_argument('--structure', default='auto', type=str,
+                        help='auto simulates diagonal systems (EV, Extreme) elementwise, dense never does')
+    parser.add_argument('--fleet_size', default=None, type=int,
+                        help='Number of chargers of an EV or Extreme fleet; the 10 of _PARAMETERS.py if unset')
+    parser.add_argument('--powers', default='auto', type=str,
+                        help='How powers of F are provided: auto, dense, eig, squaring or matvec')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='Directory of the on-disk caches (Riccati gains, simulation runs); off if unset')
+    parser.add_argument('--cache_size', default=1024, type=int,
+                        help='Size budget of the simulation run cache in MB')
+    parser.add_argument('--store', default=None, type=str,
+                        help='Directory of a resumable results store; finished cells are skipped on reruns')
+    parser.add_argument('--workers', default=0,
+                        type=int, help='Number of sweep worker processes; 0 runs the serial loop')
+    parser.add_argument('--seed', default=None,
+                        type=int, help='Root seed of the noise: the per-task streams of the sweep workers and noise '
+                                       'banks, the single stream of the serial loop')
+    parser.add_argument('--stream_window', default=None, type=int,
+                        help='Simulate each run of the serial loop in windows of this many slots with bounded memory')
+    parser.add_argument('--stream_dir', default=None, type=str,
+                        help='Directory the per-slot trajectories of streamed runs are written to; off if unset')
+    parser.add_argument('--noise_bank', default=None, type=str,
+                        help='Directory of a seeded noise bank that every run replays; generated if missing, off if '
+                             'unset')
+    parser.add_argument('--log_level', default='INFO', type=str,
+                        help='DEBUG, INFO, WARNING or ERROR; DEBUG also logs the costs of every run')
+    parser.add_argument('--progress_interval', default=5.0, type=float,
+                        help='Minimum number of seconds between progress messages')
+    parser.add_argument('--profile', default=None, type=str,
+                        help='Write per-phase timers and counters of the sweep to this JSON file; off if unset')
 
 
     configs = parser.parse_args()
@@ -40,7 +106,10 @@ def get_configs():
 def main():
 
     configs = get_configs()
-    print(configs)
+
+    logging.basicConfig(level=configs.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    logger.info('%s', configs)
+    PROFILER.enabled = configs.profile is not None
 
     # Initialize
 
@@ -50,77 +119,344 @@ def main():
     J = configs.J
     M = configs.M
 
-    A, B, Q, R, sigma, lam, mu = generate_parameters(mode, N, J)
+    if configs.fleet_size is not None:
+        A, B, Q, R, sigma, lam, mu = generate_fleet_parameters(mode, N, J, configs.fleet_size)
+    else:
+        A, B, Q, R, sigma, lam, mu = generate_parameters(mode, N, J)
+        if configs.structure == 'auto' and diagonal_structure(A, B, Q, R) is not None:
+            A, B, Q, R = diagonal_structure(A, B, Q, R)
+
+    if np.ndim(A) == 1:
+
+        # Independent scalar systems, held as diagonals and simulated elementwise
+        logger.info('Diagonal system of %d scalar blocks', np.shape(A)[0])
+        P, D, H, F = get_diagonal_gains(A, B, Q, R)
+        F_list = F
+
+    else:
 
-    P, _, _ = control.dare(A, B, Q, R)
-    D = np.matmul(np.linalg.inv(R + np.matmul(np.matmul(np.transpose(B), P), B)), np.transpose(B))
-    H = np.matmul(B, D)
-    F = A - np.matmul(H, np.matmul(P, A))
-    F_list = [np.linalg.matrix_power(F, i) for i in range(T + 1)]
+        P, D, H, F = get_gains(A, B, Q, R, configs.cache_dir)[:4]
+        F_list = FPowers(F, T + 1, configs.powers)
 
     competitive_ratio = np.zeros((J, N))
     online_competitive_ratio = np.zeros(N)
     upper_bound = np.zeros((J, N))
     epsilon = np.zeros((J, N))
     online_epsilon = np.zeros(N)
+    best_lam = None
+    truncation = np.zeros(N)
+    intervals = None
+    family = None
+    seed = configs.seed if configs.seed is not None else np.random.SeedSequence().entropy
+    curves = {}
+
+    cache = None
+    if configs.cache_dir is not None:
+        cache = RunCache(os.path.join(configs.cache_dir, 'runs'), configs.cache_size * 2 ** 20)
+
+    if configs.adaptive_tol is not None and configs.store is not None:
+        raise ValueError('The adaptive sweep chooses its sigma points as it goes and cannot use a results store')
+    if configs.sequential_tol is not None and (configs.store is not None or configs.adaptive_tol is not None):
+        raise ValueError('The sequential sweep chooses its number of runs as it goes and cannot use a results '
+                         'store or an adaptive sigma grid')
+
+    if (configs.q_scales is not None or configs.r_scales is not None) and (
+            configs.store is not None or configs.adaptive_tol is not None or configs.sequential_tol is not None):
+        raise ValueError('The family sweep runs one sweep per system and cannot use a results store, an adaptive '
+                         'sigma grid or the sequential sweep')
+
+    # A noise bank holds the per-cell streams of the sweep workers; configurations
+    # replaying the same bank see the same errors
+    bank = None
+    if configs.noise_bank is not None:
+        if configs.adaptive_tol is not None:
+            raise ValueError('The adaptive sweep chooses its sigma points as it goes and cannot use a noise bank')
+        bank = NoiseBank(configs.noise_bank, configs.seed, configs.noise, mu, sigma, T, A, M)
+        seed = bank.seed
+
+    # The store records the seed and the kind of noise streams, so a resumed sweep draws
+    # the same noise for its remaining cells; without --seed the stored seed is reused
+    store = None
+    if configs.store is not None:
+        stored = ResultStore.stored_config(configs.store)
+        if configs.seed is None and bank is None and stored is not None:
+            seed = stored['seed']
+        store = ResultStore(configs.store, N, M, J, dict(
+            mode=mode, fleet_size=configs.fleet_size, noise=configs.noise, T=T, ini_lambda=configs.ini_lambda,
+            sigma=sigma.tolist(), lam=lam.tolist(), lookahead=configs.lookahead, lookahead_tol=configs.lookahead_tol,
+            seed=seed, streams='bank' if bank is not None else 'cells' if configs.workers > 0 else 'serial'))
+
+    model = dict(T=T, A=A, B=B, Q=Q, R=R, P=P, D=D, H=H, F=F_list, mode=mode, noise=configs.noise, mu=mu,
+                 sigma=sigma, lam=lam, ini_lambda=configs.ini_lambda, lookahead=configs.lookahead,
+                 lookahead_tol=configs.lookahead_tol, cache_dir=configs.cache_dir,
+                 cache_size=configs.cache_size, noise_bank=configs.noise_bank, profile=PROFILER.enabled)
+
+    if configs.q_scales is not None or configs.r_scales is not None:
+
+        # Sweep every Q/R scaling of the system, with the gains of all of them from one
+        # batched Riccati solve; the members see the same prediction errors
+        logger.info('Sweep seed: %s', seed)
+
+        (A_family, B_family, Q_family, R_family, q_scales, r_scales) = scale_family(
+            A, B, Q, R, configs.q_scales if configs.q_scales is not None else [1],
+            configs.r_scales if configs.r_scales is not None else [1])
+        family = dict(q_scales=q_scales, r_scales=r_scales)
+        (family['competitive_ratio'], family['online_competitive_ratio'], family['epsilon'], family['online_epsilon'],
+         family['truncation'], family['upper_bound']) = family_sweep(model, A_family, B_family, Q_family, R_family,
+                                                                     N, M, seed, max(configs.workers, 1),
+                                                                     configs.powers, configs.progress_interval)
+        truncation = family['truncation']
+
+    elif configs.adaptive_tol is not None:
+
+        # Start from a coarse grid over the same range and refine it where the curves bend
+        logger.info('Sweep seed: %s', seed)
+
+        initial = np.linspace(sigma[0], sigma[-1], min(configs.adaptive_initial, N))
+        (sigma, competitive_ratio, online_competitive_ratio, epsilon, online_epsilon, truncation,
+         upper_bound) = adaptive_sweep(model, initial, M, N, configs.adaptive_tol, seed, max(configs.workers, 1),
+                                       configs.progress_interval)
+        logger.info('Adaptive sweep used %d of %d sigma points', len(sigma), N)
+
+    elif configs.sequential_tol is not None:
+
+        # Sample each error level until it converges, within a budget of N * M runs
+        logger.info('Sweep seed: %s', seed)
+
+        (competitive_ratio, online_competitive_ratio, epsilon, online_epsilon, truncation, upper_bound,
+         intervals) = sequential_sweep(model, N, N * M, configs.sequential_tol, seed, configs.min_samples,
+                                       configs.confidence, max(configs.workers, 1), configs.progress_interval)
+        for i in range(N):
+            logger.info('Sigma %.3g: %d runs, self-tuning competitive ratio %.4g, at most %.4g with %g%% '
+                        'confidence%s', sigma[i], intervals['samples'][i], online_competitive_ratio[i],
+                        intervals['endpoint_upper'][-1, i], 100 * configs.confidence,
+                        '' if np.all(intervals['converged'][:, i]) else ' (budget spent before convergence)')
+
+    elif configs.workers > 0:
+
+        # Distribute the (sigma, Monte Carlo) grid over a process pool
+        logger.info('Sweep seed: %s', seed)
+
+        competitive_ratio, online_competitive_ratio, epsilon, online_epsilon, truncation, upper_bound = run_sweep(
+            model, N, M, seed, configs.workers, store=store, progress_interval=configs.progress_interval)
+
+    else:
+
+        progress = Progress(N * M, 'Sweep', configs.progress_interval)
+        best_lam = np.full((N, M), np.nan)
+        best_ratio = np.full((N, M), np.nan)
+        logger.info('Sweep seed: %s', seed)
+        rng = np.random.default_rng(seed)
+
+        for i in range(N):
+
+            if configs.batch:
+
+                # Simulate every Monte Carlo realization of this error level in one vectorized rollout
+                if bank is not None:
+                    _batch_noise = bank.block(i)
+                else:
+                    _batch_noise = generate_noise(mu, sigma[i], T, A, configs.noise, rng, M)
+                if store is not None and all(store.is_done(i, j) for j in range(M)):
+                    progress.update(M, 'skipped')
+                    continue
+                logger.debug('Running tests ... Epsilon: %d Monte: 0-%d', i, M - 1)
+
+                _estimated_w = generate_w(mode, A, T) + _batch_noise
+                _lookahead = resolve_lookahead(T, P, F_list, _estimated_w, configs.lookahead, configs.lookahead_tol)
+                _batch_truncation = truncation_bound(T, P, F_list, _estimated_w, _lookahead) * np.ones(M)
+
+                (_batch_epsilon, X, Y, W, Z, _batch_online_ALG, _batch_OPT), _batch_coefficients = cached_batch_runs(
+                    cache, T, A, B, Q, R, _batch_noise, mode, P, D, H, F_list, configs.ini_lambda, _lookahead)
+                _batch_myopic_ALG = evaluate_lqr_cost(np.transpose(_batch_coefficients)[..., np.newaxis], lam)
+                _batch_upper_bound = compute_upper_bounds(A, B, Q, R, _batch_OPT[:, np.newaxis], lam,
+                                                          _batch_epsilon[:, np.newaxis], X[:, np.newaxis],
+                                                          Y[:, np.newaxis], W[:, np.newaxis], Z[:, np.newaxis])[2]
+
+            for j in range(M):
+
+                if configs.batch:
+
+                    _epsilon, _online_ALG, _OPT = _batch_epsilon[j], _batch_online_ALG[j], _batch_OPT[j]
+                    _all_myopic_ALG = _batch_myopic_ALG[j]
+                    _coefficients = _batch_coefficients[j]
+                    _truncation = _batch_truncation[j]
+                    _all_upper_bound = _batch_upper_bound[j]
+
+                elif configs.stream_window is not None:
+
+                    # Noise is drawn window by window from the same stream as generate_noise, also for
+                    # finished cells; the lookahead is fixed, and no curve is plotted
+                    if store is not None and store.is_done(i, j):
+                        for start in range(0 if bank is None else T, T, configs.stream_window):
+                            generate_noise(mu, sigma[i], min(configs.stream_window, T - start), A, configs.noise, rng)
+                        progress.update(1, 'skipped')
+                        continue
+                    logger.debug('Running tests ... Epsilon: %d Monte: %d', i, j)
+
+                    _writer = None
+                    if configs.stream_dir is not None:
+                        _writer = StreamWriter(os.path.join(configs.stream_dir, str(i) + '_' + str(j)), T,
+                                               np.shape(A)[0], np.shape(B)[-1])
+                    if bank is not None:
+                        _noise = bank.stream(i, j)
+                    else:
+                        _noise = lambda length: generate_noise(mu, sigma[i], length, A, configs.noise, rng)
+                    _epsilon, X, Y, W, Z, _online_ALG, _OPT, _coefficients, _truncation = run_stream_lqr_robot(
+                        T, A, B, Q, R, _noise, mode, P, D, H, F_list, configs.ini_lambda, configs.lookahead,
+                        configs.stream_window, _writer)
+                    _all_myopic_ALG = evaluate_lqr_cost(_coefficients, lam)
+                    _all_upper_bound = compute_upper_bounds(A, B, Q, R, _OPT, lam, _epsilon, X, Y, W, Z)[2]
+
+                else:
+
+                    # Noise is drawn even for finished cells, so the remaining ones see the same stream
+                    if bank is not None:
+                        noise = bank.get(i, j)
+                    else:
+                        noise = generate_noise(mu, sigma[i], T, A, configs.noise, rng)
+                    if store is not None and store.is_done(i, j):
+                        progress.update(1, 'skipped')
+                        continue
+                    logger.debug('Running tests ... Epsilon: %d Monte: %d', i, j)
+
+                    _estimated_w = generate_w(mode, A, T) + noise
+                    _lookahead = resolve_lookahead(T, P, F_list, _estimated_w, configs.lookahead, configs.lookahead_tol)
+                    _truncation = truncation_bound(T, P, F_list, _estimated_w, _lookahead)
+
+                    # Run self-tuning control; plotted runs bypass the run cache and hand their
+                    # trajectory to the renderer after the sweep
+                    if configs.plot_curve and mode == 'Tracking':
+                        _curve = []
+                        _epsilon, X, Y, W, Z, _online_ALG, _OPT = run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P,
+                                                                                    D, H, F_list, configs.ini_lambda,
+                                                                                    _curve, _lookahead)
+                        curves[i, j] = _curve[0]
+                    else:
+                        _epsilon, X, Y, W, Z, _online_ALG, _OPT = cached_fix_lqr_robot(
+                            cache, T, A, B, Q, R, noise, mode, P, D, H, F_list, configs.ini_lambda, _lookahead)
+
+                    # Run lambda-confident control; its cost is quadratic in the trust parameter,
+                    # so a single rollout prices every lambda on the grid
+                    _coefficients = cached_lqr_cost_coefficients(cache, T, A, B, Q, R, noise, mode, P, D, H, F_list,
+                                                                 _lookahead)
+                    _all_myopic_ALG = evaluate_lqr_cost(_coefficients, lam)
+
+                    # Theoretical bound of every trust parameter, in one evaluation
+                    _all_upper_bound = compute_upper_bounds(A, B, Q, R, _OPT, lam, _epsilon, X, Y, W, Z)[2]
+
+                truncation[i] = max(truncation[i], _truncation)
+
+                # Trust parameter in [0, 1] minimizing this realization's cost in hindsight
+                best_lam[i, j], _best_ALG = find_best_lam(_coefficients, 0, 1)
+                if _OPT != 0:
+                    best_ratio[i, j] = _best_ALG / _OPT
+
+                if store is not None and not store.is_done(i, j):
+                    store.write(i, j, _epsilon, _online_ALG, _OPT, _all_myopic_ALG, _truncation, _all_upper_bound)
+
+                if _OPT != 0 and _online_ALG / _OPT > online_competitive_ratio[i]:
+                    online_competitive_ratio[i] = _online_ALG / _OPT
+                    online_epsilon[i] = _epsilon
+
+                for k in range(J):
+
+                    _myopic_ALG = _all_myopic_ALG[k]
+
+                    if _OPT != 0 and _myopic_ALG / _OPT > competitive_ratio[k, i]:
+                        competitive_ratio[k, i] = _myopic_ALG / _OPT
+                        epsilon[k, i] = _epsilon
+                        upper_bound[k, i] = _all_upper_bound[k]
+
+                progress.update(1, 'Epsilon: ' + str(i) + ' Monte: ' + str(j))
 
-    for i in range(N):
+        if cache is not None:
+            logger.info('Run cache hits: %d misses: %d', cache.hits, cache.misses)
 
-        for j in range(M):
+        for i in range(N):
+            if not np.all(np.isnan(best_ratio[i])):
+                logger.info('Sigma %.3g: best lambda in hindsight %.3g on average, its competitive ratio at most %.4g',
+                            sigma[i], np.nanmean(best_lam[i]), np.nanmax(best_ratio[i]))
+
+        if store is not None:
+
+            # Include the cells finished by earlier runs
+            (competitive_ratio, online_competitive_ratio, epsilon, online_epsilon, truncation,
+             upper_bound) = store.reduce()
+
+    if configs.lookahead is not None or configs.lookahead_tol is not None:
+        logger.info('Feedforward truncation bound per error level: %s', truncation)
+
+    if configs.profile is not None:
+        PROFILER.save(configs.profile)
+        for name, phase in sorted(PROFILER.report()['phases'].items(), key=lambda item: -item[1]['seconds']):
+            logger.info('Phase %s: %.3fs in %d calls', name, phase['seconds'], phase['calls'])
+        logger.info('Profile written to %s', configs.profile)
 
-            noise = generate_noise(mu, sigma[i], T, A, configs.noise)
-            print('Runing tests ... ' + 'Epsilon:' + str(i) + ' Monte:' + str(j))
+    # Rendering; matplotlib is only imported here, once the simulations are done
 
-            # Run self-tuning control
-            _epsilon, X, Y, W, Z, _online_ALG, _OPT = run_fix_lqr_robot(T, A, B, Q, R, noise, mode, P,
-                                                                                 D, H, F_list, configs.ini_lambda, configs.plot_curve)
-            if _OPT != 0 and _online_ALG / _OPT > online_competitive_ratio[i]:
-                online_competitive_ratio[i] = _online_ALG / _OPT
-                online_epsilon[i] = _epsilon
+    if curves:
 
-            for k in range(J):
+        from plots import render_tracking
 
-                print('Runing tests ... ' + 'Epsilon:' + str(i) + ' Monte:' + str(j) + ' Lambda:' + str(k))
+        for (i, j), (_online_x, _FTL_all_lam) in curves.items():
+            render_tracking(os.path.join(configs.plot_dir, 'tracking_' + str(i) + '_' + str(j)), _online_x,
+                            _FTL_all_lam)
+        logger.info('Tracking curves written to %s', configs.plot_dir)
 
-                # Run lambda-confident control with different trust patameters
-                _myopic_ALG = run_lqr_robot(T, A, B, Q, R, noise, lam[k], mode, P, D, H, F_list)
+    if configs.plot_output and family is not None:
 
-                if _OPT != 0 and _myopic_ALG / _OPT > competitive_ratio[k, i]:
-                    competitive_ratio[k, i] = _myopic_ALG / _OPT
-                    epsilon[k, i] = _epsilon
-                    # upper_bound[k, i] = compute_upper_bound(A, B, Q, R, _OPT, lam[k], _epsilon, X, Y, W, Z)
+        from plots import render_family
 
+        render_family(os.path.join(configs.plot_dir, 'family.png'), family['q_scales'], family['r_scales'],
+                      family['competitive_ratio'], lam, family['online_competitive_ratio'])
+        logger.info('Competitive ratios of the family written to %s', os.path.join(configs.plot_dir, 'family.png'))
 
-    if configs.plot_output:
+    elif configs.plot_output:
 
-        # Plotting
-        colors = ['blue', 'red', 'green', 'orange', 'gray', 'brown', 'cyan', 'magenta', 'yellow', 'skyblue', 'black']
-        bound_color_index = 0
+        from plots import render_competitive_ratio, render_upper_bound
+
+        annotation = None
+        if intervals is not None:
+            annotation = np.array(intervals['endpoint_upper'][:J])
 
         for k in range(J):
             _, upper_bound[k] = (list(t) for t in zip(*sorted(zip(epsilon[k], upper_bound[k]))))
+            if annotation is not None:
+                _, annotation[k] = (list(t) for t in zip(*sorted(zip(epsilon[k], annotation[k]))))
             epsilon[k], competitive_ratio[k] = (list(t) for t in zip(*sorted(zip(epsilon[k], competitive_ratio[k]))))
-            plot_competitive_ratio(np.array(epsilon[k]), np.array(competitive_ratio[k]), lam[k], colors[bound_color_index],False)
-            # plot_upper_bound(np.array(epsilon[k]), upper_bound[k], lam[k], colors[bound_color_index])
-            bound_color_index += 1
 
-        online_epsilon, online_competitve_ratio = (list(t) for t in zip(*sorted(zip(online_epsilon, online_competitive_ratio))))
-        plot_competitive_ratio(np.array(online_epsilon), np.array(online_competitive_ratio), 0, 'black', True)
+        render_upper_bound(os.path.join(configs.plot_dir, 'upper_bound.png'), epsilon, competitive_ratio, upper_bound,
+                           lam)
+
+        online_epsilon, online_competitive_ratio = (list(t) for t in zip(*sorted(zip(online_epsilon, online_competitive_ratio))))
+
+        render_competitive_ratio(os.path.join(configs.plot_dir, 'competitive_ratio.png'), epsilon, competitive_ratio,
+                                 lam, online_epsilon, online_competitive_ratio, annotation)
+        logger.info('Competitive ratios written to %s', os.path.join(configs.plot_dir, 'competitive_ratio.png'))
+
+    if configs.save_output and family is not None:
 
-        plt.title("Algorithm Performance")
-        plt.xlabel('Prediction Error ' + r"$\varepsilon$")
-        plt.ylabel("Competitive Ratios")
-        # plt.ylabel("Upper Bounds")
-        plt.grid()
-        plt.show()
+        np.savez("family.npz", lam=lam, sigma=sigma, **family)
 
-    if configs.save_output:
+    elif configs.save_output:
 
         # Save data
         np.save("cp.npy", competitive_ratio)
         np.save("ocp.npy", online_competitive_ratio)
         np.save("e.npy", epsilon)
         np.save("oe.npy", online_epsilon)
+        np.save("ub.npy", upper_bound)
+        if configs.adaptive_tol is not None:
+            np.save("sigma.npy", sigma)
+        if intervals is not None:
+            np.savez("ci.npz", **intervals)
+        if configs.lookahead is not None or configs.lookahead_tol is not None:
+            np.save("tb.npy", truncation)
+        if best_lam is not None:
+            # Per realization of the serial loop; NaN for cells finished by an earlier run
+            np.save("ls.npy", best_lam)
+            np.save("lcp.npy", best_ratio)
 
 
 
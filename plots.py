@@ -1,5 +1,11 @@
-import matplotlib.pyplot as plt
+import matplotlib
 import numpy as np
+import os
+
+# Figures are written to files, so rendering never needs a display or blocks on a window
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
 
 def plot_lambda(lam):
 
@@ -38,3 +44,109 @@ def plot_upper_bound(epsilon, upper_bound, lam, color):
 
     plt.plot(epsilon/1000, upper_bound,  color=color, linestyle='dashed', label=r'$\lambda=$'+str(round(lam, 1)))
     plt.legend(loc='upper left', scatterpoints=1, frameon=True, labelspacing=0.2, title=r'$\lambda$' + ' Values')
+
+
+# Renderers, run after the simulations
+
+def _save(path):
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+
+def render_tracking(prefix, online_x, lam):
+
+    # Tracked trajectory of the self-tuning policy and its lambdas, written to
+    # <prefix>_track.png and <prefix>_lambda.png
+
+    from model import tracking_coordinates
+
+    y = np.zeros((np.shape(online_x)[0], 2))
+    y[:, 0], y[:, 1] = tracking_coordinates(np.arange(np.shape(online_x)[0]))
+
+    plt.figure()
+    segments = [(r'$t\in [0,60]$', 'blue'), (r'$t\in (60,90]$', 'green'), (r'$t\in [90,150]$', 'magenta'),
+                (r'$t\in [150,210]$', 'gray')]
+    for k, (context, color) in enumerate(segments):
+        if 60 * k < np.shape(online_x)[0]:
+            plot_track(online_x[60 * k:60 * (k + 1)], y[60 * k:60 * (k + 1)], context, color)
+    plot_trajectory(y[0:240], 'black')
+    plt.grid()
+    _save(prefix + '_track.png')
+
+    plt.figure()
+    plot_lambda(lam)
+    _save(prefix + '_lambda.png')
+
+
+def render_competitive_ratio(path, epsilon, competitive_ratio, lam, online_epsilon, online_competitive_ratio,
+                             upper=None):
+
+    # upper, (J, N) like competitive_ratio, shades each curve up to a confidence bound
+    # on the largest ratio
+
+    colors = ['blue', 'red', 'green', 'orange', 'gray', 'brown', 'cyan', 'magenta', 'yellow', 'skyblue', 'black']
+
+    plt.figure()
+    for k in range(len(lam)):
+        plot_competitive_ratio(np.array(epsilon[k]), np.array(competitive_ratio[k]), lam[k], colors[k % len(colors)],
+                               False)
+        if upper is not None:
+            plt.fill_between(np.array(epsilon[k]) / 1000, np.array(competitive_ratio[k]), np.array(upper[k]),
+                             color=colors[k % len(colors)], alpha=0.15, linewidth=0)
+        # plot_upper_bound(np.array(epsilon[k]), upper_bound[k], lam[k], colors[k % len(colors)])
+    plot_competitive_ratio(np.array(online_epsilon), np.array(online_competitive_ratio), 0, 'black', True)
+
+    plt.title("Algorithm Performance")
+    plt.xlabel('Prediction Error ' + r"$\varepsilon$")
+    plt.ylabel("Competitive Ratios")
+    # plt.ylabel("Upper Bounds")
+    plt.grid()
+    _save(path)
+
+
+def render_upper_bound(path, epsilon, competitive_ratio, upper_bound, lam):
+
+    # Empirical competitive ratios (solid) next to the theoretical bounds (dashed)
+
+    colors = ['blue', 'red', 'green', 'orange', 'gray', 'brown', 'cyan', 'magenta', 'yellow', 'skyblue', 'black']
+
+    plt.figure()
+    for k in range(len(lam)):
+        plot_competitive_ratio(np.array(epsilon[k]), np.array(competitive_ratio[k]), lam[k], colors[k % len(colors)],
+                               False)
+        plot_upper_bound(np.array(epsilon[k]), np.array(upper_bound[k]), lam[k], colors[k % len(colors)])
+
+    plt.yscale('log')
+    plt.title("Upper Bounds")
+    plt.xlabel('Prediction Error ' + r"$\varepsilon$")
+    plt.ylabel("Competitive Ratios")
+    plt.grid()
+    _save(path)
+
+
+def render_family(path, q_scales, r_scales, competitive_ratio, lam, online_competitive_ratio):
+
+    # Largest competitive ratio over the error levels of every member of a family of
+    # systems: competitive_ratio (K, J, N) and online_competitive_ratio (K, N) for the
+    # K members, labelled by the scalings of Q and R
+
+    colors = ['blue', 'red', 'green', 'orange', 'gray', 'brown', 'cyan', 'magenta', 'yellow', 'skyblue', 'black']
+    members = np.arange(len(q_scales))
+
+    plt.figure()
+    for k in range(len(lam)):
+        plt.plot(members, np.max(competitive_ratio[:, k], axis=-1), color=colors[k % len(colors)], marker='o',
+                 label=r'$\lambda=$' + str(round(lam[k], 1)))
+    plt.plot(members, np.max(online_competitive_ratio, axis=-1), color='black', marker='o', label='Online')
+    plt.legend(loc='upper left', scatterpoints=1, frameon=True, labelspacing=0.2, title=r'$\lambda$' + ' Values')
+
+    ticks = np.unique(np.linspace(0, len(members) - 1, min(len(members), 10)).astype(int))
+    plt.xticks(ticks, ['q=' + format(q_scales[k], 'g') + '\nr=' + format(r_scales[k], 'g') for k in ticks])
+    plt.title("Sensitivity to the Cost Weights")
+    plt.xlabel('Scalings of Q and R')
+    plt.ylabel("Competitive Ratios")
+    plt.grid()
+    _save(path)
@@ -0,0 +1,217 @@
+from model import *
+from model import _find_all_lam, _find_lam, _get_norms, _get_power_norms
+from _PARAMETERS import *
+from benchmarks import get_system
+import numpy as np
+import argparse
+import sys
+import time
+
+
+# Reference checks: the recursive FTLLambda estimator and the correlation-based norm
+# statistics against the dense O(T^2) loops they replaced, at horizons short enough
+# for the loops. Horizons of at least 512 slots also cover the FFT path of the norms.
+# The power norms are also timed at a long horizon, where they have to stop early.
+
+def reference_find_lam(t, w, estimated_w, P, F, H, ini_lambda):
+
+    prediction_perturbation = 0
+    prediction_prediction = 0
+
+    for s in range(t):
+        left_1 = 0
+        left_2 = 0
+        right = 0
+        for l in range(s, t):
+            left_1 += np.matmul(np.matmul(np.transpose(estimated_w[l]), np.transpose(P)), F[l - s])
+            left_2 += np.matmul(np.matmul(np.transpose(w[l]), np.transpose(P)), F[l - s])
+            right += np.transpose(np.matmul(np.matmul(np.transpose(estimated_w[l]), np.transpose(P)), F[l - s]))
+        prediction_prediction += np.matmul(left_1, np.matmul(H, right))
+        prediction_perturbation += np.matmul(left_2, np.matmul(H, right))
+
+    if prediction_prediction != 0:
+        lam_optimal = prediction_perturbation / prediction_prediction
+    else:
+        lam_optimal = ini_lambda
+
+    return lam_optimal
+
+
+def reference_find_all_lam(T, w, estimated_w, P, F, H, size, ini_lambda):
+
+    all_lam_optimal = []
+    matrix_w = np.zeros((T, T, size))
+    matrix_est_w = np.zeros((T, T, size))
+    for t in range(T):
+        prediction_prediction = 0
+        prediction_perturbation = 0
+        matrix_w[t, t] = np.matmul(P, w[t])
+        matrix_est_w[t, t] = np.matmul(P, estimated_w[t])
+        for s in range(t):
+            matrix_w[s, t] = matrix_w[s, t-1] + np.matmul(np.transpose(F[t-s]), w[t])
+            matrix_est_w[s, t] = matrix_est_w[s, t-1] + np.matmul(np.transpose(F[t-s]), estimated_w[t])
+            prediction_prediction += np.matmul(np.transpose(matrix_est_w[s, t]), np.matmul(H, matrix_est_w[s, t]))
+            prediction_perturbation += np.matmul(np.transpose(matrix_w[s, t]), np.matmul(H, matrix_est_w[s, t]))
+        if prediction_prediction != 0:
+            lam_optimal = prediction_perturbation / prediction_prediction
+        else:
+            lam_optimal = ini_lambda
+        all_lam_optimal.append(lam_optimal)
+    return all_lam_optimal
+
+
+def reference_norms(T, noise, w, estimated_w, P, F):
+
+    # The "Compute norms" loop of run_fix_lqr_robot, with ||F^k||_2 ||P||_2 computed
+    # once per lag instead of once per (t, s)
+
+    table = [np.linalg.norm(F[k], 2) * np.linalg.norm(P, 2) for k in range(T)]
+    W = 0
+    Z = 0
+    Y = 0
+    X = 0
+    epsilon = 0
+
+    for t in range(T):
+        inner_epsilon = 0
+        inner_W = 0
+        inner_Z = 0
+        for s in range(t, T):
+            inner_epsilon += table[s - t] * np.linalg.norm(noise[s])
+            inner_W += table[s - t] * np.linalg.norm(estimated_w[s])
+            inner_Z += table[s - t] * np.linalg.norm(w[s])
+        epsilon += inner_epsilon ** 2
+        W += inner_W ** 2
+        Z += inner_Z ** 2
+        Y += inner_epsilon * inner_Z
+        X += inner_Z * inner_W
+
+    return epsilon, X, Y, W, Z
+
+
+def _difference(value, reference):
+
+    # Largest difference relative to the largest reference value
+
+    value, reference = np.asarray(value, dtype=float), np.asarray(reference, dtype=float)
+
+    return np.max(np.abs(value - reference)) / max(np.max(np.abs(reference)), np.finfo(float).tiny)
+
+
+def run_checks(horizons, modes, sigma, M, seed):
+
+    # Relative difference of every check, keyed by name/mode/T
+
+    differences = {}
+    rng = np.random.default_rng(seed)
+
+    for mode in modes:
+
+        A, B, Q, R, _, _, mu = generate_parameters(mode, 1, 1)
+        P, D, H, F = get_gains(A, B, Q, R)[:4]
+        n = np.shape(A)[0]
+
+        for T in horizons:
+
+            F_list = FPowers(F, T + 1, 'dense')
+            w = generate_w(mode, A, T)
+            noise = generate_noise(mu, sigma, T, A, 'Binomial', rng, M)
+            estimated_w = w + noise
+            key = '/' + mode + '/T=' + str(T)
+
+            reference = reference_find_all_lam(T, w, estimated_w[0], P, F_list, H, n, 0.3)
+            differences['_find_all_lam' + key] = _difference(_find_all_lam(T, w, estimated_w[0], P, F_list, H, n, 0.3),
+                                                             reference)
+
+            # The abs-clipping of run_fix_lqr_robot, applied by the estimator itself
+            estimator = FTLLambda(P, F, H, 0.3, clip=True)
+            differences['FTLLambda clip' + key] = _difference([estimator.update(w[t], estimated_w[0, t])
+                                                               for t in range(T)], np.abs(reference))
+
+            # One estimator over a leading Monte Carlo axis
+            estimator = FTLLambda(P, F, H, 0.3)
+            batch = np.transpose([estimator.update(w[t], estimated_w[:, t]) for t in range(T)])
+            differences['FTLLambda batch' + key] = max(
+                _difference(batch[m], reference_find_all_lam(T, w, estimated_w[m], P, F_list, H, n, 0.3))
+                for m in range(1, M))
+
+            slots = np.unique(np.linspace(0, T, 6).astype(int))[:3] if T > 64 else np.arange(0, T, max(T // 8, 1))
+            differences['_find_lam' + key] = max(
+                _difference(_find_lam(t, w, estimated_w[0], P, F_list, H, 0.3),
+                            reference_find_lam(t, w, estimated_w[0], P, F_list, H, 0.3)) for t in slots)
+
+            reference = np.transpose([reference_norms(T, noise[m], w, estimated_w[m], P, F_list) for m in range(M)])
+            differences['_get_norms' + key] = _difference(_get_norms(T, noise, w, estimated_w, P, F_list), reference)
+
+            for name in [name for name in differences if name.endswith(key)]:
+                print(name + ': ' + format(differences[name], '.2e'))
+
+    return differences
+
+
+def time_power_norms(T, systems):
+
+    # Seconds _get_power_norms takes for T powers of each system's F; the norms of a
+    # stable F fall below machine precision after a short lag, where it has to stop
+
+    seconds = {}
+
+    for system in systems:
+        _, A, B, Q, R = get_system(system)
+        F = get_gains(A, B, Q, R).F
+        start = time.perf_counter()
+        norms = _get_power_norms(F, T)
+        key = '_get_power_norms/' + system + '/T=' + str(T)
+        seconds[key] = time.perf_counter() - start
+        print(key + ': ' + str(round(seconds[key], 3)) + ' s, ' + str(np.count_nonzero(norms)) + ' nonzero norms')
+
+    return seconds
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Recursive lambda estimator and norm statistics against the dense '
+                                                 'O(T^2) loops they replaced')
+
+    parser.add_argument('--T', default=[40, 600], type=int, nargs='+',
+                        help='Horizons to check; at least 512 also covers the FFT path of the norms')
+    parser.add_argument('--modes', default=['Tracking', 'EV'], type=str, nargs='+',
+                        help='Tracking, EV or Extreme')
+    parser.add_argument('--sigma', default=0.5, type=float,
+                        help='Scale of the Binomial prediction errors')
+    parser.add_argument('--M', default=3, type=int,
+                        help='Number of noise realizations, checked together as a batch')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the prediction errors')
+    parser.add_argument('--tol', default=1e-10, type=float,
+                        help='Largest allowed difference relative to the reference values')
+    parser.add_argument('--power_T', default=100000, type=int,
+                        help='Horizon at which the power norms are timed')
+    parser.add_argument('--power_systems', default=['Tracking', 'EV', 'Synthetic100'], type=str, nargs='+',
+                        help='Systems whose power norms are timed, as in benchmarks.py')
+    parser.add_argument('--time_limit', default=2.0, type=float,
+                        help='Largest allowed number of seconds for the power norms of one system')
+
+    configs = parser.parse_args()
+
+    differences = run_checks(configs.T, configs.modes, configs.sigma, configs.M, configs.seed)
+    failures = [name for name, difference in differences.items() if not difference <= configs.tol]
+
+    for name in failures:
+        print('MISMATCH ' + name + ': ' + format(differences[name], '.2e'))
+
+    seconds = time_power_norms(configs.power_T, configs.power_systems)
+    slow = [name for name, value in seconds.items() if value > configs.time_limit]
+
+    for name in slow:
+        print('TOO SLOW ' + name + ': ' + str(round(seconds[name], 3)) + ' s')
+
+    if failures or slow:
+        sys.exit(1)
+
+    print('All ' + str(len(differences)) + ' checks within ' + str(configs.tol) + ', power norms within '
+          + str(configs.time_limit) + ' s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import numpy as np
+import json
+import os
+
+
+# Results store
+#
+# A directory of .npy files opened as memory maps plus manifest.json:
+#   alg.npy        (N, M, J)   cost of the lambda-confident policy per trust parameter
+#   online_alg.npy (N, M)      cost of the self-tuning policy
+#   opt.npy        (N, M)      offline optimal cost
+#   eps.npy        (N, M)      epsilon of the noise realization
+#   truncation.npy (N, M)      feedforward truncation bound
+#   bound.npy      (N, M, J)   theoretical upper bound on the competitive ratio per trust parameter
+#   done.npy       (N, M, J+1) finished cells, index J is the self-tuning cell
+#   cp.npy, ocp.npy, e.npy, oe.npy: running maxima in the format of data/data200-300-*
+#   ub.npy         (J, N)      upper bound of the realization attaining each maximum in cp.npy
+
+_VERSION = 2
+
+
+class ResultStore:
+
+    def __init__(self, path, N, M, J, config=None):
+
+        self.path = path
+        self.N = N
+        self.M = M
+        self.J = J
+
+        manifest = dict(version=_VERSION, N=N, M=M, J=J, config=config or {})
+        manifest_path = os.path.join(path, 'manifest.json')
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                existing = json.load(f)
+            if existing != json.loads(json.dumps(manifest)):
+                raise ValueError('Results store ' + path + ' was created for a different sweep')
+            mode = 'r+'
+        else:
+            os.makedirs(path, exist_ok=True)
+            mode = 'w+'
+
+        self.alg = self._open('alg.npy', mode, (N, M, J))
+        self.online_alg = self._open('online_alg.npy', mode, (N, M))
+        self.opt = self._open('opt.npy', mode, (N, M))
+        self.eps = self._open('eps.npy', mode, (N, M))
+        self.truncation = self._open('truncation.npy', mode, (N, M))
+        self.bound = self._open('bound.npy', mode, (N, M, J))
+        self.done = self._open('done.npy', mode, (N, M, J + 1), bool)
+        self.competitive_ratio = self._open('cp.npy', mode, (J, N))
+        self.online_competitive_ratio = self._open('ocp.npy', mode, (N,))
+        self.epsilon = self._open('e.npy', mode, (J, N))
+        self.online_epsilon = self._open('oe.npy', mode, (N,))
+        self.upper_bound = self._open('ub.npy', mode, (J, N))
+
+        # The manifest goes last, so a store only counts as created once every array exists
+        if mode == 'w+':
+            temporary = manifest_path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(temporary, manifest_path)
+
+    @staticmethod
+    def stored_config(path):
+
+        # The config an existing store was created with, None if there is no store at path
+
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                return json.load(f)['config']
+        except FileNotFoundError:
+            return None
+
+    def _open(self, name, mode, shape, dtype=np.float64):
+
+        return np.lib.format.open_memmap(os.path.join(self.path, name), mode=mode, dtype=dtype, shape=shape)
+
+    def is_done(self, i, j, k=None):
+
+        if k is None:
+            return bool(np.all(self.done[i, j]))
+
+        return bool(self.done[i, j, k])
+
+    def write_online(self, i, j, epsilon, online_ALG, OPT, truncation=0):
+
+        # The self-tuning cell carries the realization's epsilon and OPT, which the
+        # lambda cells of the same (i, j) are compared against
+
+        self.eps[i, j] = epsilon
+        self.online_alg[i, j] = online_ALG
+        self.opt[i, j] = OPT
+        self.truncation[i, j] = truncation
+        written = [self.eps, self.online_alg, self.opt, self.truncation]
+
+        if OPT != 0 and online_ALG / OPT > self.online_competitive_ratio[i]:
+            self.online_competitive_ratio[i] = online_ALG / OPT
+            self.online_epsilon[i] = epsilon
+            written += [self.online_competitive_ratio, self.online_epsilon]
+
+        self._finish(i, j, self.J, written)
+
+    def write_lam(self, i, j, k, myopic_ALG, upper_bound=0):
+
+        if not self.done[i, j, self.J]:
+            raise ValueError('The self-tuning cell of (' + str(i) + ', ' + str(j) + ') must be written first')
+
+        self.alg[i, j, k] = myopic_ALG
+        self.bound[i, j, k] = upper_bound
+        written = [self.alg, self.bound]
+
+        OPT = self.opt[i, j]
+        if OPT != 0 and myopic_ALG / OPT > self.competitive_ratio[k, i]:
+            self.competitive_ratio[k, i] = myopic_ALG / OPT
+            self.epsilon[k, i] = self.eps[i, j]
+            self.upper_bound[k, i] = upper_bound
+            written += [self.competitive_ratio, self.epsilon, self.upper_bound]
+
+        self._finish(i, j, k, written)
+
+    def write(self, i, j, epsilon, online_ALG, OPT, all_myopic_ALG, truncation=0, all_upper_bound=None):
+
+        self.write_online(i, j, epsilon, online_ALG, OPT, truncation)
+        for k in range(self.J):
+            self.write_lam(i, j, k, all_myopic_ALG[k], 0 if all_upper_bound is None else all_upper_bound[k])
+
+    def _finish(self, i, j, k, written):
+
+        # The written values are flushed before their done flag, so a crash never marks
+        # a cell whose values are missing
+
+        for array in written:
+            array.flush()
+        self.done[i, j, k] = True
+        self.done.flush()
+
+    def results(self):
+
+        # Finished (i, j) cells as the tuples run_task returns
+
+        return {(i, j): (i, j, self.eps[i, j], self.online_alg[i, j], self.opt[i, j], self.alg[i, j],
+                         self.truncation[i, j], self.bound[i, j])
+                for i in range(self.N) for j in range(self.M) if self.is_done(i, j)}
+
+    def reduce(self):
+
+        # Recompute the running maxima in the serial (i, j, k) order, so ties resolve as
+        # in an uninterrupted run, and store them
+
+        from sweep import reduce_sweep
+
+        reduced = reduce_sweep(self.results(), self.N, self.M, self.J, skip_missing=True)
+
+        for array, value in zip((self.competitive_ratio, self.online_competitive_ratio, self.epsilon,
+                                 self.online_epsilon, self.upper_bound), reduced[:4] + reduced[5:]):
+            array[...] = value
+            array.flush()
+
+        return reduced
@@ -0,0 +1,120 @@
+from sweep import run_cells, run_ratios, reduce_sweep
+from instrument import logger
+import numpy as np
+import statistics
+
+
+# Sequential Monte Carlo
+#
+# Instead of M runs per error level, every level is sampled until the confidence
+# intervals of all its (sigma, lambda) cells are within tol, or the budget of runs
+# is spent. One run prices every trust parameter, so a level stops once its last
+# cell has converged and its share of the budget goes to the levels still sampling.
+
+class RunningStats:
+
+    # Streaming mean and variance (Welford) and the two largest values of a vector of
+    # ratios, one entry per cell
+
+    def __init__(self, size):
+
+        self.n = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.first = np.full(size, -np.inf)
+        self.second = np.full(size, -np.inf)
+
+    def update(self, x):
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.second = np.maximum(self.second, np.minimum(self.first, x))
+        self.first = np.maximum(self.first, x)
+
+    def variance(self):
+
+        return self.m2 / max(self.n - 1, 1)
+
+    def half_width(self, confidence):
+
+        # Half width of the normal confidence interval of the mean
+
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+        return z * np.sqrt(self.variance() / max(self.n, 1))
+
+    def endpoint(self, confidence=None):
+
+        # Extreme-value estimate of the largest attainable ratio from the two largest
+        # samples (Robson and Whitlock): first + (first - second), or the upper end of
+        # its one-sided interval, first + confidence / (1 - confidence) * (first - second)
+
+        if self.n < 2:
+            return np.full(np.shape(self.first), np.inf)
+
+        gap = self.first - self.second
+        if confidence is None:
+            return self.first + gap
+
+        return self.first + confidence / (1 - confidence) * gap
+
+    def converged(self, tol, confidence):
+
+        # Cells whose mean interval and maximum interval [first, endpoint] are both
+        # within tol of the largest ratio
+
+        scale = tol * np.abs(self.first)
+
+        return (self.half_width(confidence) <= scale) & (self.endpoint(confidence) - self.first <= scale)
+
+
+def sequential_sweep(model, N, budget, tol, seed, min_samples=3, confidence=0.95, workers=1,
+                     progress_interval=5.0):
+
+    # model as for run_sweep. Every error level first gets min_samples runs; then, round
+    # by round, each level that has not converged gets up to half as many runs again as
+    # it has, sharing what is left of the budget of runs. Returns the outputs of
+    # reduce_sweep over all runs and a dict of per-cell statistics, indexed (J + 1, N)
+    # with the self-tuning policy last: samples (N,), mean, half_width, endpoint,
+    # endpoint_upper and converged
+
+    J = len(model['lam'])
+    stats = [RunningStats(J + 1) for i in range(N)]
+    results = {}
+
+    active = list(range(N))
+    steps = {i: min(min_samples, max(budget // N, 1)) for i in active}
+
+    while active:
+
+        tasks = [(i, stats[i].n + j, seed) for i in active for j in range(steps[i])]
+        new = run_cells(model, tasks, workers, progress_interval=progress_interval)
+        for i, j, _ in tasks:
+            stats[i].update(run_ratios(new[i, j]))
+        results.update(new)
+        budget -= len(tasks)
+
+        active = [i for i in active if not np.all(stats[i].converged(tol, confidence))]
+        logger.info('Sequential sweep: %d runs, %d of %d error levels sampling', len(results), len(active), N)
+
+        # Share the rest of the budget, least sampled levels first
+
+        steps = {}
+        remaining = budget
+        for k, i in enumerate(sorted(active, key=lambda i: stats[i].n)):
+            step = min(max(stats[i].n // 2, 1), -(-remaining // (len(active) - k)))
+            if step > 0:
+                steps[i] = step
+                remaining -= step
+        active = list(steps)
+
+    summary = dict(samples=np.array([s.n for s in stats]),
+                   mean=np.transpose([s.mean for s in stats]),
+                   half_width=np.transpose([s.half_width(confidence) for s in stats]),
+                   endpoint=np.transpose([s.endpoint() for s in stats]),
+                   endpoint_upper=np.transpose([s.endpoint(confidence) for s in stats]),
+                   converged=np.transpose([s.converged(tol, confidence) for s in stats]))
+
+    return reduce_sweep(results, N, int(np.max(summary['samples'])), J, skip_missing=True) + (summary,)
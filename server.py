@@ -0,0 +1,258 @@
+from controller import *
+from _PARAMETERS import *
+from instrument import logger
+import numpy as np
+import argparse
+import asyncio
+import collections
+import logging
+import time
+
+
+# Prediction feed
+
+class Forecaster:
+
+    # In-process stand-in for the prediction feed: the perturbations of generate_w_range
+    # plus Gaussian errors of standard deviation sigma, redrawn at every forecast, for a
+    # window of lookahead slots. All requests of a batch are served by one vectorized draw.
+
+    def __init__(self, mode, A, lookahead, sigma=0.0, seed=None):
+
+        self.mode = mode
+        self.A = A
+        self.lookahead = lookahead
+        self.sigma = sigma
+        self._rng = np.random.default_rng(seed)
+        self._w = np.zeros((0, np.shape(A)[0]))
+
+    def perturbation(self, slots):
+
+        # Realized perturbations of the given slots
+
+        slots = np.asarray(slots)
+        stop = int(slots.max()) + 1 if slots.size else 0
+        if stop > len(self._w):
+            stop = max(stop, 2 * len(self._w))
+            self._w = np.concatenate([self._w, generate_w_range(self.mode, self.A, len(self._w), stop)])
+
+        return self._w[slots]
+
+    def predict(self, slots):
+
+        # (b, lookahead, n) predicted perturbations of slots t, ..., t + lookahead - 1 for
+        # every t in slots
+
+        w = self.perturbation(np.asarray(slots)[:, np.newaxis] + np.arange(self.lookahead))
+
+        return w + self.sigma * self._rng.standard_normal(np.shape(w))
+
+
+# Server
+
+class ControlServer:
+
+    # asyncio front end of a ControllerBank. Step requests that arrive within `window`
+    # seconds of the first one waiting are evaluated together: one forecast for all of
+    # them and one ControllerBank.step. A controller is expected to await its action
+    # before sending its next state; a second request of the same controller within a
+    # batch waits for the next one.
+
+    def __init__(self, bank, forecaster, window=1e-3, max_batch=8192, history=100000):
+
+        self.bank = bank
+        self.forecaster = forecaster
+        self.window = window
+        self.max_batch = max_batch
+
+        self.requests = 0
+        self.batches = 0
+        self._latencies = collections.deque(maxlen=history)
+        self._batch_sizes = collections.deque(maxlen=history)
+        self._queue = None
+        self._task = None
+        self._start = None
+
+    def register(self, count=1):
+
+        return self.bank.add(count)
+
+    async def start(self):
+
+        self._queue = asyncio.Queue()
+        self._start = time.perf_counter()
+        self._task = asyncio.create_task(self._serve())
+
+    async def stop(self):
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def step(self, controller, x):
+
+        # Action of the controller in state x at its next slot
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((controller, x, future, time.perf_counter()))
+
+        return await future
+
+    async def _serve(self):
+
+        waiting = []
+
+        while True:
+
+            if not waiting:
+                waiting.append(await self._queue.get())
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            while not self._queue.empty():
+                waiting.append(self._queue.get_nowait())
+
+            batch = []
+            later = []
+            seen = set()
+            for request in waiting:
+                if request[0] in seen or len(batch) >= self.max_batch:
+                    later.append(request)
+                else:
+                    seen.add(request[0])
+                    batch.append(request)
+            waiting = later
+
+            self._evaluate(batch)
+
+    def _evaluate(self, batch):
+
+        ids = np.array([request[0] for request in batch])
+        x = np.array([request[1] for request in batch])
+
+        try:
+            u, _ = self.bank.step(ids, x, self.forecaster.predict(self.bank.t[ids]))
+        except Exception as error:
+            logger.error('Batch of %d steps failed: %s', len(batch), error)
+            for request in batch:
+                if not request[2].done():
+                    request[2].set_exception(error)
+            return
+
+        now = time.perf_counter()
+        for k, request in enumerate(batch):
+            if not request[2].done():
+                request[2].set_result(u[k])
+            self._latencies.append(now - request[3])
+
+        self.requests += len(batch)
+        self.batches += 1
+        self._batch_sizes.append(len(batch))
+
+    def metrics(self):
+
+        # Throughput since start and batch size and latency statistics of the latest
+        # `history` requests, latencies in milliseconds from arrival to action
+
+        latencies = 1e3 * np.array(self._latencies) if self._latencies else np.zeros(1)
+        elapsed = time.perf_counter() - self._start
+
+        return dict(requests=self.requests, batches=self.batches, steps_per_second=self.requests / elapsed,
+                    mean_batch=float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0,
+                    p50_ms=float(np.percentile(latencies, 50)), p99_ms=float(np.percentile(latencies, 99)),
+                    p999_ms=float(np.percentile(latencies, 99.9)), max_ms=float(np.max(latencies)))
+
+
+# Load test
+
+async def _plant(server, controller, A, B, forecaster, T, diagonal):
+
+    # Closed loop of one site: send the state, apply the action, observe the perturbation
+
+    x = np.zeros(np.shape(A)[0])
+
+    for t in range(T):
+        u = await server.step(controller, x)
+        if diagonal:
+            x = A * x + B * u + forecaster.perturbation(t)
+        else:
+            x = np.matmul(A, x) + np.matmul(B, u) + forecaster.perturbation(t)
+
+
+async def run_load(server, A, B, forecaster, controllers, T, diagonal):
+
+    await server.start()
+    ids = server.register(controllers)
+    await asyncio.gather(*(_plant(server, c, A, B, forecaster, T, diagonal) for c in ids))
+    await server.stop()
+
+    return server.metrics()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Load test of the batching multi-tenant control server')
+
+    parser.add_argument('--mode', default='EV', type=str,
+                        help='Tracking, EV or Extreme')
+    parser.add_argument('--controllers', default=2000, type=int,
+                        help='Number of controller instances hosted by the server')
+    parser.add_argument('--T', default=50, type=int,
+                        help='Number of time slots each controller is stepped')
+    parser.add_argument('--lookahead', default=20, type=int,
+                        help='Number of predicted slots of each forecast')
+    parser.add_argument('--sigma', default=0.1, type=float,
+                        help='Standard deviation of the prediction errors of the forecaster')
+    parser.add_argument('--window', default=1e-3, type=float,
+                        help='Seconds the server waits to gather step requests into a batch')
+    parser.add_argument('--max_batch', default=8192, type=int,
+                        help='Largest number of step requests evaluated together')
+    parser.add_argument('--structure', default='auto', type=str,
+                        help='auto steps diagonal systems (EV, Extreme) elementwise, dense never does')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also time one SelfTuningController.step call per controller and slot')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the forecast errors')
+
+    configs = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    A, B, Q, R, _, _, _ = generate_parameters(configs.mode, 1, 1)
+    if configs.structure == 'auto' and diagonal_structure(A, B, Q, R) is not None:
+        A, B, Q, R = diagonal_structure(A, B, Q, R)
+    diagonal = np.ndim(A) == 1
+    P, D, H, F = get_diagonal_gains(A, B, Q, R) if diagonal else get_gains(A, B, Q, R)[:4]
+
+    bank = ControllerBank(A, B, P, D, H, F, configs.lookahead, capacity=configs.controllers)
+    forecaster = Forecaster(configs.mode, A, configs.lookahead, configs.sigma, configs.seed)
+    server = ControlServer(bank, forecaster, configs.window, configs.max_batch)
+
+    metrics = asyncio.run(run_load(server, A, B, forecaster, configs.controllers, configs.T, diagonal))
+
+    print('Controllers: ' + str(configs.controllers) + ', slots: ' + str(configs.T))
+    print('Throughput (steps/s): ' + str(round(metrics['steps_per_second'])))
+    print('Mean batch: ' + str(round(metrics['mean_batch'], 1)) + ' in ' + str(metrics['batches']) + ' batches')
+    print('Latency p50 / p99 / p99.9 (ms): ' + str(round(metrics['p50_ms'], 2)) + ' / '
+          + str(round(metrics['p99_ms'], 2)) + ' / ' + str(round(metrics['p999_ms'], 2)))
+
+    if configs.compare:
+
+        # One Python call per controller per slot, the predictions handed over directly
+        if diagonal:
+            A, B, P, D, H, F = (np.diag(v) for v in (A, B, P, D, H, F))
+        controllers = [SelfTuningController(A, B, P, D, H, F) for c in range(configs.controllers)]
+        x = np.zeros((configs.controllers, np.shape(A)[0]))
+        start = time.perf_counter()
+        for t in range(configs.T):
+            predictions = forecaster.predict(t * np.ones(configs.controllers, dtype=int))
+            for c, controller in enumerate(controllers):
+                u = controller.step(x[c], predictions[c])
+                x[c] = np.matmul(A, x[c]) + np.matmul(B, u) + forecaster.perturbation(t)
+        print('Unbatched throughput (steps/s): ' + str(round(configs.controllers * configs.T
+                                                              / (time.perf_counter() - start))))
+
+
+if __name__ == '__main__':
+    main()
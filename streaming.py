@@ -0,0 +1,221 @@
+from model import *
+from model import _get_G, _get_diagonal_G, _get_norm_table, _suffix_correlation
+from instrument import PROFILER
+import numpy as np
+import json
+import os
+
+
+# Streaming simulation
+#
+# The horizon is processed in windows of `window` slots. ||F^k|| ||P|| decays
+# geometrically, so every suffix sum (the feedforward, the offline optimal and the
+# norm statistics) is cut at the lag beyond which its tail is below double precision;
+# the buffers then only hold window + lag rows of perturbations and predictions and
+# memory does not grow with T. The results match run_fix_lqr_robot and
+# lqr_cost_coefficients up to round-off. When F is not stable the lag is the whole
+# horizon and nothing is saved.
+
+def negligible_lag(T, P, F):
+
+    # Smallest lag k whose tail sum_{k' >= k} ||F^k'|| ||P|| is below machine precision
+    # of the whole sum; T if there is none
+
+    length = min(T, 1024)
+
+    while True:
+        table = _get_norm_table(length, P, F)
+        tail = np.cumsum(table[::-1])[::-1]
+        below = np.flatnonzero(tail <= np.finfo(float).eps * tail[0])
+        if len(below) or length == T:
+            return int(below[0]) if len(below) else T
+        length = min(T, 2 * length)
+
+
+def _stream_feedforward(P, F, w, lookahead, diagonal):
+
+    # Feedforward of the buffered slots; rows within `lookahead` of the buffer end
+    # are only exact at the end of the horizon
+
+    if diagonal:
+        return _get_diagonal_G(P, F, w, lookahead)
+
+    return _get_G(P, F[1], w, lookahead, F)
+
+
+def stream_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead=None, window=4096):
+
+    # Generator over windows of the self-tuning, offline optimal and lambda-confident
+    # (as in lqr_cost_coefficients) policies. noise(length) returns the next `length`
+    # rows of prediction errors, e.g. lambda length: generate_noise(mu, sigma, length, A, type, rng),
+    # which draws the same stream as a single call. Each window yields a dict with
+    # start, stop, the self-tuned lam, the states, actions and per-step costs of the
+    # self-tuning and optimal policies, the per-step (a, b, c) cost coefficients,
+    # the window's share of epsilon, X, Y, W and Z and its largest truncation bound.
+
+    diagonal = np.ndim(P) == 1
+    n = np.shape(A)[0]
+    lag = negligible_lag(T, P, F)
+    if lookahead is not None and lookahead >= lag:
+        lookahead = None
+
+    table = np.array(_get_norm_table(min(T, window + lag), P, F))
+    table[lag:] = 0
+    truncated = np.array(table)
+    truncated[:lag if lookahead is None else lookahead] = 0
+
+    if diagonal:
+        K = D * P * A
+        estimator = DiagonalFTLLambda(P, F, H, ini_lambda)
+    else:
+        K = np.matmul(D, np.matmul(P, A))
+        estimator = FTLLambda(P, F[1], H, ini_lambda)
+
+    # Policies stacked as self-tuning, optimal, x0 (feedback only) and x1 (feedforward only)
+    x = np.zeros((4, n))
+    disturbed = np.array([1.0, 1.0, 1.0, 0.0])[:, np.newaxis]
+
+    w = np.zeros((0, n))
+    errors = np.zeros((0, n))
+    end = 0
+
+    for start in range(0, T, window):
+
+        stop = min(start + window, T)
+        size = stop - start
+
+        # Extend the buffers to slots [start, stop + lag)
+
+        if min(stop + lag, T) > end:
+            w = np.concatenate([w, generate_w_range(mode, A, end, min(stop + lag, T))])
+            errors = np.concatenate([errors, noise(min(stop + lag, T) - end)])
+            end = min(stop + lag, T)
+        estimated_w = w + errors
+
+        # Self-tuned lambdas
+
+        with PROFILER.phase('lambda'):
+            lam = np.array([estimator.update(w[t], estimated_w[t]) for t in range(size)])
+        lam = np.where((lam < 0) | (lam > 1), np.abs(lam), lam)
+
+        # Feedforward terms of the four policies
+
+        G = _stream_feedforward(P, F, estimated_w, lookahead, diagonal)[:size]
+        G_optimal = _stream_feedforward(P, F, w, None, diagonal)[:size]
+        if diagonal:
+            DG, DG_optimal = D * G, D * G_optimal
+        else:
+            DG, DG_optimal = np.matmul(G, np.transpose(D)), np.matmul(G_optimal, np.transpose(D))
+        feedforward = np.stack([lam[:, np.newaxis] * DG, DG_optimal, np.zeros(np.shape(DG)), DG])
+
+        # Rollout
+
+        states = np.zeros((4, size, n))
+        actions = np.zeros(np.shape(feedforward))
+
+        with PROFILER.phase('rollout'):
+            for t in range(size):
+                states[:, t] = x
+                if diagonal:
+                    actions[:, t] = -K * x - feedforward[:, t]
+                    x = A * x + B * actions[:, t] + disturbed * w[t]
+                else:
+                    actions[:, t] = -np.matmul(x, np.transpose(K)) - feedforward[:, t]
+                    x = np.matmul(x, np.transpose(A)) + np.matmul(actions[:, t], np.transpose(B)) + disturbed * w[t]
+        PROFILER.count('rollouts', 4)
+
+        # Per-step costs, with the terminal cost x^T P x at slot T - 1
+
+        with PROFILER.phase('cost'):
+            if diagonal:
+                cost = np.einsum('ptn,n,ptn->pt', states, Q, states) + np.einsum('ptm,m,ptm->pt', actions, R, actions)
+                cross = (np.einsum('tn,n,tn->t', states[2], Q, states[3])
+                         + np.einsum('tm,m,tm->t', actions[2], R, actions[3]))
+            else:
+                cost = (np.einsum('ptn,nk,ptk->pt', states, Q, states)
+                        + np.einsum('ptm,mk,ptk->pt', actions, R, actions))
+                cross = (np.einsum('tn,nk,tk->t', states[2], Q, states[3])
+                         + np.einsum('tm,mk,tk->t', actions[2], R, actions[3]))
+            if stop == T and diagonal:
+                cost[:, -1] = np.einsum('pn,n,pn->p', states[:, -1], P, states[:, -1])
+                cross[-1] = np.sum(states[2, -1] * P * states[3, -1])
+            elif stop == T:
+                cost[:, -1] = np.einsum('pn,nk,pk->p', states[:, -1], P, states[:, -1])
+                cross[-1] = np.matmul(states[2, -1], np.matmul(P, states[3, -1]))
+
+        # Shares of the norm statistics
+
+        with PROFILER.phase('norms'):
+            inner_epsilon = _suffix_correlation(table[:end - start], np.linalg.norm(errors, axis=-1))[:size]
+            inner_W = _suffix_correlation(table[:end - start], np.linalg.norm(estimated_w, axis=-1))[:size]
+            inner_Z = _suffix_correlation(table[:end - start], np.linalg.norm(w, axis=-1))[:size]
+            truncation = np.max(_suffix_correlation(truncated[:end - start],
+                                                    np.linalg.norm(estimated_w, axis=-1))[:size])
+
+        yield dict(start=start, stop=stop, lam=lam,
+                   online_x=states[0], online_u=actions[0], online_cost=cost[0],
+                   optimal_x=states[1], optimal_u=actions[1], optimal_cost=cost[1],
+                   coefficients=np.stack([cost[2], 2 * cross, cost[3]], axis=-1),
+                   epsilon=np.sum(inner_epsilon ** 2), X=np.sum(inner_Z * inner_W), Y=np.sum(inner_epsilon * inner_Z),
+                   W=np.sum(inner_W ** 2), Z=np.sum(inner_Z ** 2), truncation=truncation)
+
+        # Drop the slots of this window
+
+        w = w[size:]
+        errors = errors[size:]
+
+
+def run_stream_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead=None, window=4096,
+                         callback=None):
+
+    # Consumes stream_lqr_robot, handing every window to callback, and returns
+    # epsilon, X, Y, W, Z, online_ALG and OPT as run_fix_lqr_robot does, plus the
+    # coefficients of lqr_cost_coefficients and the truncation bound of the lookahead
+
+    totals = dict(epsilon=0, X=0, Y=0, W=0, Z=0, online_ALG=0, OPT=0, coefficients=np.zeros(3), truncation=0)
+
+    for record in stream_lqr_robot(T, A, B, Q, R, noise, mode, P, D, H, F, ini_lambda, lookahead, window):
+        for name in ('epsilon', 'X', 'Y', 'W', 'Z'):
+            totals[name] += record[name]
+        totals['online_ALG'] += np.sum(record['online_cost'])
+        totals['OPT'] += np.sum(record['optimal_cost'])
+        totals['coefficients'] += np.sum(record['coefficients'], axis=0)
+        totals['truncation'] = max(totals['truncation'], record['truncation'])
+        if callback is not None:
+            callback(record)
+
+    return (totals['epsilon'], totals['X'], totals['Y'], totals['W'], totals['Z'], totals['online_ALG'],
+            totals['OPT'], totals['coefficients'], totals['truncation'])
+
+
+# Writing streams to disk
+
+class StreamWriter:
+
+    # Callback for run_stream_lqr_robot that writes the per-slot records into .npy
+    # memory maps in a directory, flushed after every window:
+    #   lam.npy (T,), online_x.npy / optimal_x.npy (T, n), online_u.npy / optimal_u.npy (T, m),
+    #   online_cost.npy / optimal_cost.npy (T,), coefficients.npy (T, 3)
+    # progress.json records the number of slots written.
+
+    _FIELDS = ('lam', 'online_x', 'online_u', 'online_cost', 'optimal_x', 'optimal_u', 'optimal_cost', 'coefficients')
+
+    def __init__(self, path, T, n, m):
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        shapes = dict(lam=(T,), online_x=(T, n), online_u=(T, m), online_cost=(T,), optimal_x=(T, n),
+                      optimal_u=(T, m), optimal_cost=(T,), coefficients=(T, 3))
+        self.arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                       dtype=np.float64, shape=shapes[name])
+                       for name in self._FIELDS}
+
+    def __call__(self, record):
+
+        for name in self._FIELDS:
+            self.arrays[name][record['start']:record['stop']] = record[name]
+            self.arrays[name].flush()
+
+        with open(os.path.join(self.path, 'progress.json'), 'w') as f:
+            json.dump(dict(slots=record['stop']), f)
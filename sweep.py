@@ -0,0 +1,207 @@
+from model import *
+from memo import *
+from instrument import PROFILER, Progress
+from bundle import BundleSpec, ModelBundle, attach
+from noise_bank import NoiseBank, task_rng
+import numpy as np
+import concurrent.futures
+import os
+
+
+# Worker state, installed once per process by _init_worker
+
+_SWEEP_MODEL = {}
+
+
+def _init_worker(model):
+
+    # model is the dict itself or, in pool workers, the BundleSpec of its shared copy
+
+    _SWEEP_MODEL.clear()
+
+    if isinstance(model, BundleSpec):
+        model, memory = attach(model)
+        _SWEEP_MODEL['bundle'] = memory
+        if 'w' in model:
+            prime_w(model['mode'], model['A'], model['T'], model['w'])
+
+    _SWEEP_MODEL.update(model)
+
+    # Gains solved by the parent, e.g. for a member of a family of systems
+    if model.get('gains') is not None:
+        prime_gains(model['A'], model['B'], model['Q'], model['R'], model['gains'])
+
+    if model.get('noise_bank') is not None:
+        _SWEEP_MODEL['bank'] = NoiseBank.load(model['noise_bank'])
+
+    if model.get('profile'):
+        PROFILER.enabled = True
+
+    if model.get('cache_dir') is not None:
+        _SWEEP_MODEL['cache'] = RunCache(os.path.join(model['cache_dir'], 'runs'),
+                                         model.get('cache_size', 1024) * 2 ** 20)
+
+
+def run_task(i, j, seed):
+
+    m = _SWEEP_MODEL
+    T, A, B, Q, R = m['T'], m['A'], m['B'], m['Q'], m['R']
+    P, D, H, F = m['P'], m['D'], m['H'], m['F']
+
+    # A noise bank holds the same stream for the cells it covers
+    bank = m.get('bank')
+    if bank is not None and i < np.shape(bank)[0] and j < np.shape(bank)[1]:
+        noise = bank[i, j]
+    else:
+        noise = generate_noise(m['mu'], m['sigma'][i], T, A, m['noise'], task_rng(seed, i, j))
+
+    _estimated_w = generate_w(m['mode'], A, T) + noise
+    _lookahead = resolve_lookahead(T, P, F, _estimated_w, m.get('lookahead'), m.get('lookahead_tol'))
+    _truncation = truncation_bound(T, P, F, _estimated_w, _lookahead)
+
+    # Run self-tuning control
+    _epsilon, X, Y, W, Z, _online_ALG, _OPT = cached_fix_lqr_robot(m.get('cache'), T, A, B, Q, R, noise, m['mode'],
+                                                                   P, D, H, F, m['ini_lambda'], _lookahead)
+
+    # Run lambda-confident control for every trust parameter
+    _coefficients = cached_lqr_cost_coefficients(m.get('cache'), T, A, B, Q, R, noise, m['mode'], P, D, H, F,
+                                                 _lookahead)
+    _all_myopic_ALG = evaluate_lqr_cost(_coefficients, m['lam'])
+
+    # Theoretical bound of every trust parameter for this realization
+    _all_upper_bound = compute_upper_bounds(A, B, Q, R, _OPT, m['lam'], _epsilon, X, Y, W, Z)[2]
+
+    return i, j, _epsilon, _online_ALG, _OPT, _all_myopic_ALG, _truncation, _all_upper_bound
+
+
+def _run_chunk(tasks):
+
+    # Returns the results and, when profiling, the phase timings of this chunk alone
+
+    if not PROFILER.enabled:
+        return [run_task(i, j, seed) for i, j, seed in tasks], None
+
+    outer = PROFILER.report()
+    PROFILER.reset()
+    results = [run_task(i, j, seed) for i, j, seed in tasks]
+    report = PROFILER.report()
+    PROFILER.reset()
+    PROFILER.merge(outer)
+
+    return results, report
+
+
+def run_ratios(result):
+
+    # Ratios ALG / OPT of a run_task result, the J trust parameters then the self-tuning
+    # policy; 0 when OPT = 0, as reduce_sweep skips those runs
+
+    _, _, _, _online_ALG, _OPT, _all_myopic_ALG, _, _ = result
+
+    if _OPT == 0:
+        return np.zeros(len(_all_myopic_ALG) + 1)
+
+    return np.append(_all_myopic_ALG, _online_ALG) / _OPT
+
+
+def reduce_sweep(results, N, M, J, skip_missing=False):
+
+    # Max competitive ratios, the epsilon and upper bound of the realization attaining
+    # them, scanned in the same (i, j, k) order as the serial loop in pipeline.main,
+    # plus the largest feedforward truncation bound per error level
+
+    competitive_ratio = np.zeros((J, N))
+    online_competitive_ratio = np.zeros(N)
+    epsilon = np.zeros((J, N))
+    online_epsilon = np.zeros(N)
+    truncation = np.zeros(N)
+    upper_bound = np.zeros((J, N))
+
+    for i in range(N):
+        for j in range(M):
+
+            if skip_missing and (i, j) not in results:
+                continue
+
+            _, _, _epsilon, _online_ALG, _OPT, _all_myopic_ALG, _truncation, _all_upper_bound = results[i, j]
+            truncation[i] = max(truncation[i], _truncation)
+
+            if _OPT != 0 and _online_ALG / _OPT > online_competitive_ratio[i]:
+                online_competitive_ratio[i] = _online_ALG / _OPT
+                online_epsilon[i] = _epsilon
+
+            for k in range(J):
+                if _OPT != 0 and _all_myopic_ALG[k] / _OPT > competitive_ratio[k, i]:
+                    competitive_ratio[k, i] = _all_myopic_ALG[k] / _OPT
+                    epsilon[k, i] = _epsilon
+                    upper_bound[k, i] = _all_upper_bound[k]
+
+    return competitive_ratio, online_competitive_ratio, epsilon, online_epsilon, truncation, upper_bound
+
+
+def run_cells(model, tasks, workers=1, chunk_size=None, store=None, progress_interval=5.0):
+
+    # Runs the (i, j, seed) tasks and returns their results keyed by (i, j); finished
+    # cells are written to the ResultStore as they complete and worker profiles are
+    # merged into PROFILER
+
+    if chunk_size is None:
+        chunk_size = max(1, len(tasks) // (4 * max(workers, 1)))
+    chunks = [tasks[c:c + chunk_size] for c in range(0, len(tasks), chunk_size)]
+
+    results = {}
+    progress = Progress(len(tasks), 'Sweep', progress_interval)
+
+    def collect(chunk):
+        chunk_results, report = chunk
+        if report is not None:
+            PROFILER.merge(report)
+        progress.update(len(chunk_results))
+        for result in chunk_results:
+            results[result[0], result[1]] = result
+            if store is not None:
+                i, j, _epsilon, _online_ALG, _OPT, _all_myopic_ALG, _truncation, _all_upper_bound = result
+                store.write(i, j, _epsilon, _online_ALG, _OPT, _all_myopic_ALG, _truncation, _all_upper_bound)
+
+    if workers <= 1:
+        _init_worker(model)
+        for chunk in chunks:
+            collect(_run_chunk(chunk))
+    else:
+
+        # Workers attach to one shared copy of the arrays, including the powers of F with
+        # their norms and the perturbation trajectory, so tasks only carry (i, j, seed);
+        # the gains come along, so no worker solves the DARE for compute_upper_bounds
+        if isinstance(model['F'], FPowers):
+            model['F'].norms()
+
+        gains = model.get('gains')
+        if gains is None and np.ndim(model['A']) == 2:
+            gains = get_gains(model['A'], model['B'], model['Q'], model['R'], model.get('cache_dir'))
+
+        with ModelBundle(dict(model, w=generate_w(model['mode'], model['A'], model['T']), gains=gains)) as bundle:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                        initargs=(bundle.spec,)) as executor:
+                futures = [executor.submit(_run_chunk, chunk) for chunk in chunks]
+                for future in concurrent.futures.as_completed(futures):
+                    collect(future.result())
+
+    return results
+
+
+def run_sweep(model, N, M, seed, workers=1, chunk_size=None, store=None, progress_interval=5.0):
+
+    # model holds T, A, B, Q, R, P, D, H, F, mode, noise, mu, sigma, lam, ini_lambda and
+    # optionally lookahead / lookahead_tol, cache_dir / cache_size, noise_bank (a NoiseBank
+    # directory), gains (the Gains of A, B, Q and R) and profile; results are identical for
+    # any number of workers. With a ResultStore, finished cells are skipped and new ones
+    # are written as they complete. Worker profiles are merged into PROFILER
+
+    tasks = [(i, j, seed) for i in range(N) for j in range(M) if store is None or not store.is_done(i, j)]
+
+    results = run_cells(model, tasks, workers, chunk_size, store, progress_interval)
+
+    if store is not None:
+        return store.reduce()
+
+    return reduce_sweep(results, N, M, len(model['lam']))